@@ -5,35 +5,54 @@
 """Hotpot - Jupyter kernel manager helpers
 """
 
-from ._version import __version__
-
-from .limited import MaximumKernelsException, SyncLimitedKernelManager
-from .pooled_sync import SyncPooledKernelManager
-
-__all__ = [
-    "__version__",
-    "MaximumKernelsException",
-    "SyncPooledKernelManager",
-    "SyncLimitedKernelManager",
-]
-
-try:
-    from .pooled import PooledKernelManager
+from importlib import import_module
 
-    __all__.append("PooledKernelManager")
-except ImportError:
-    pass
-
-try:
-    from .limited import LimitedKernelManager
-
-    __all__.append("LimitedKernelManager")
-except ImportError:
-    pass
-
-try:
-    from .mapping import PooledMappingKernelManager
+from ._version import __version__
 
-    __all__.append("PooledMappingKernelManager")
-except ImportError:
-    pass
+# The public names, and the submodules they are loaded from on first access.
+# This keeps e.g. the client stack and jupyter_server from being imported
+# before they are needed.
+_lazy_attributes = {
+    "KernelQuotaException": ".limited",
+    "MaximumKernelsException": ".limited",
+    "SyncPooledKernelManager": ".pooled_sync",
+    "SyncLimitedKernelManager": ".limited",
+    "PooledKernelManager": ".pooled",
+    "LimitedKernelManager": ".limited",
+    "PooledMappingKernelManager": ".mapping",
+}
+
+
+def _importable_names():
+    """The public names whose modules can be imported (e.g. not the async
+    managers on jupyter_client < 6, or the mapping manager without jupyter_server)
+    """
+    names = ["__version__"]
+    for name in _lazy_attributes:
+        try:
+            __getattr__(name)
+        except AttributeError:
+            continue
+        names.append(name)
+    return names
+
+
+def __getattr__(name):
+    if name == "__all__":
+        # Resolved on first use, as it needs to import the submodules
+        value = globals()["__all__"] = _importable_names()
+        return value
+    module = _lazy_attributes.get(name)
+    if module is None:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    try:
+        value = getattr(import_module(module, __name__), name)
+    except ImportError as e:
+        # E.g. jupyter_server is not installed
+        raise AttributeError("module %r has no attribute %r (%s)" % (__name__, name, e)) from e
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_attributes))
@@ -0,0 +1,94 @@
+# coding: utf-8
+
+# Copyright (c) Vidar Tonaas Fauske.
+# Distributed under the terms of the Modified BSD License.
+"""Hotpot - Jupyter kernel manager helpers
+
+This script runs a template ("zygote") process for Python kernels. It is run
+directly by path with the kernel's Python, so it must not import hotpot_km.
+
+The process imports ipykernel and the modules given as arguments, then reads
+one JSON request per line from stdin. For each request, it forks a child
+that runs an ipykernel with the requested arguments, and writes the pid of
+the child as a JSON line to stdout. The process exits when stdin is closed.
+"""
+
+import gc
+import importlib
+import json
+import os
+import signal
+import sys
+import traceback
+
+
+def _run_kernel(request):
+    """Run a kernel in a forked child. Never returns."""
+    code = 1
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        os.setsid()
+        # Detach from the request pipes:
+        devnull = os.open(os.devnull, os.O_RDWR)
+        os.dup2(devnull, 0)
+        os.dup2(2, 1)
+        os.close(devnull)
+
+        os.environ.clear()
+        os.environ.update(request["env"])
+        # Let the kernel exit if the zygote exits
+        os.environ.setdefault("JPY_PARENT_PID", str(os.getppid()))
+        if request.get("cwd"):
+            os.chdir(request["cwd"])
+        sys.argv = [sys.executable] + request["argv"]
+
+        from ipykernel import kernelapp
+
+        kernelapp.launch_new_instance()
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def main(modules):
+    # Children are reaped automatically, and interrupts are left to the server
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if sys.path[0] in ("", os.path.dirname(os.path.abspath(__file__))):
+        del sys.path[0]
+
+    import ipykernel.kernelapp  # noqa: F401
+
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            traceback.print_exc()
+
+    # Keep the imported objects out of the collector, so that their memory
+    # pages stay shared with the children:
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+
+    out = sys.stdout
+    out.write("ready\n")
+    out.flush()
+    for line in sys.stdin:
+        request = json.loads(line)
+        pid = os.fork()
+        if pid == 0:
+            _run_kernel(request)
+        out.write(json.dumps({"pid": pid}) + "\n")
+        out.flush()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
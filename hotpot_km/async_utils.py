@@ -2,6 +2,7 @@
 # Distributed under the terms of the Modified BSD License.
 
 import asyncio
+import collections
 import sys
 import inspect
 from typing import Callable, Awaitable, Any, Union
@@ -22,6 +23,51 @@ async def await_then_kill(km, aw_id):
     return await km.shutdown_kernel(await aw_id)
 
 
+class FairSemaphore:
+    """A semaphore that serves waiters round-robin by key, and FIFO within a key.
+
+    This ensures that many waiters for one key cannot starve waiters for
+    another key.
+    """
+
+    def __init__(self, value):
+        self._value = value
+        # Mapping of key -> deque of waiter futures, ordered by next in turn
+        self._waiters = collections.OrderedDict()
+
+    def __len__(self):
+        """The number of waiters in the queue"""
+        return sum(
+            1 for queue in self._waiters.values() for fut in queue if not fut.done()
+        )
+
+    async def acquire(self, key=None):
+        if self._value > 0:
+            self._value -= 1
+            return
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters.setdefault(key, collections.deque()).append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # We were woken up, so pass on the slot
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            key, queue = self._waiters.popitem(last=False)
+            fut = queue.popleft()
+            if queue:
+                # Move key to the back of the line
+                self._waiters[key] = queue
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._value += 1
+
+
 def ensure_event_loop():
     try:
         loop = asyncio.get_event_loop()
@@ -0,0 +1,79 @@
+# coding: utf-8
+
+# Copyright (c) Vidar Tonaas Fauske.
+# Distributed under the terms of the Modified BSD License.
+"""Hotpot - Jupyter kernel manager helpers
+
+This module contains helpers for sizing kernel pools based on demand.
+"""
+
+import math
+from time import monotonic
+
+
+class DemandTracker:
+    """Tracks the arrival rate of kernel requests per kernel name.
+
+    The rate is an exponentially weighted moving average, where the weight of
+    an arrival halves every `halflife` seconds.
+    """
+
+    def __init__(self, halflife):
+        self.halflife = halflife
+        # Mapping of kernel name -> (decayed arrival count, time of last update)
+        self._counts = {}
+
+    def _decayed(self, name, now):
+        count, last = self._counts.get(name, (0.0, now))
+        if self.halflife <= 0:
+            return 0.0
+        return count * 0.5 ** ((now - last) / self.halflife)
+
+    def record(self, name, now=None):
+        """Record the arrival of a request for a kernel"""
+        now = monotonic() if now is None else now
+        self._counts[name] = (self._decayed(name, now) + 1, now)
+
+    def rate(self, name, now=None):
+        """The estimated number of requests per second"""
+        if self.halflife <= 0:
+            return 0.0
+        now = monotonic() if now is None else now
+        return self._decayed(name, now) * math.log(2) / self.halflife
+
+
+def allocate_targets(demand, bounds, capacity=None):
+    """Compute pool sizes from expected demand.
+
+    Parameters
+    ----------
+    demand : dict
+        Mapping of kernel name to the number of kernels expected to be
+        requested while a replacement is being warmed up. This is rounded
+        to the nearest integer.
+    bounds : dict
+        Mapping of kernel name to a (minimum, maximum) pool size tuple.
+    capacity : int, optional
+        The total number of kernels available for pooling. Names with
+        the highest demand are given precedence if this is exceeded.
+
+    Returns
+    -------
+    A mapping of kernel name to pool size.
+    """
+    targets = {}
+    for name, (lower, upper) in bounds.items():
+        # Round to nearest, as the demand estimate never fully decays to zero
+        wanted = math.floor(demand.get(name, 0) + 0.5)
+        targets[name] = max(lower, min(upper, wanted))
+    if capacity is not None:
+        for name in sorted(targets, key=lambda n: demand.get(n, 0), reverse=True):
+            targets[name] = max(0, min(targets[name], capacity))
+            capacity -= targets[name]
+    return targets
+
+
+__all__ = [
+    "DemandTracker",
+    "allocate_targets",
+]
@@ -9,25 +9,26 @@ import atexit
 import collections
 import datetime
 import base64
-import signal
+import json
+import weakref
 from textwrap import dedent
 
-from async_generator import asynccontextmanager
-from contextlib import contextmanager
+from contextlib import asynccontextmanager, contextmanager
+from itertools import chain
 
-from time import monotonic
-from queue import Empty
 import asyncio
 import typing as t
 
 from traitlets.config.configurable import LoggingConfigurable
 from traitlets import List, Unicode, Bool, Enum, Any, Type, Dict, Integer, default
 
-from nbformat.v4 import output_from_msg
+import zmq
+import zmq.asyncio
 from jupyter_client import KernelManager
 from jupyter_client.client import KernelClient
 
 from .async_utils import run_sync, ensure_async
+from .process_exit import wait_for_exit
 
 
 class ControlSignal(Exception):
@@ -76,6 +77,134 @@ def timestamp() -> str:
     return datetime.datetime.utcnow().isoformat() + "Z"
 
 
+async def check_heartbeat(km: KernelManager, timeout: float) -> bool:
+    """Whether the kernel responds on its heartbeat channel within timeout seconds"""
+    socket = zmq.asyncio.Context.instance().socket(zmq.REQ)
+    socket.linger = 0
+    try:
+        socket.connect(km._make_url("hb"))
+        await socket.send(b"ping")
+        if await socket.poll(timeout * 1000):
+            await socket.recv()
+            return True
+        return False
+    finally:
+        socket.close()
+
+
+def _output_from_msg(msg: t.Dict) -> t.Dict:
+    # nbformat is slow to import, so wait until there is an output
+    from nbformat.v4 import output_from_msg
+
+    return output_from_msg(msg)
+
+
+def _output_size(out: t.Dict) -> int:
+    """The approximate size in bytes of the content of an output"""
+    size = 0
+    values = chain((out.get("text", ""),), out.get("data", {}).values(), out.get("traceback", ()))
+    for value in values:
+        if not isinstance(value, str):
+            value = json.dumps(value)
+        size += len(value.encode("utf-8", "replace"))
+    return size
+
+
+class OutputBuffer(collections.deque):
+    """A ring buffer of outputs, that drops the oldest outputs beyond a count or size.
+
+    A limit of 0 means no limit.
+    """
+
+    def __init__(self, max_count: int = 0, max_bytes: int = 0) -> None:
+        super().__init__(maxlen=max_count or None)
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        # The number of outputs that have been dropped:
+        self.dropped = 0
+
+    def append(self, out: t.Dict) -> None:
+        if self.maxlen is not None and len(self) == self.maxlen:
+            self.nbytes -= _output_size(self.popleft())
+            self.dropped += 1
+        super().append(out)
+        self.nbytes += _output_size(out)
+        while self.max_bytes and self.nbytes > self.max_bytes and len(self) > 1:
+            self.nbytes -= _output_size(self.popleft())
+            self.dropped += 1
+
+
+class _OutputQueue:
+    """Passes the outputs of an execution on to an execute_stream consumer"""
+
+    def __init__(self) -> None:
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    def append(self, out: t.Dict) -> None:
+        self.queue.put_nowait(out)
+
+
+class _PendingExecution:
+    """The futures of an execute request, resolved by the message routers"""
+
+    def __init__(self, outputs: t.Optional[t.Any] = None):
+        # Where to append the outputs, instead of the stored outputs:
+        self.outputs = outputs
+        loop = asyncio.get_event_loop()
+        # The execute_reply message:
+        self.reply = loop.create_future()
+        # Resolved when the kernel has gone idle after the request:
+        self.idle = loop.create_future()
+
+
+class ClientRegistry:
+    """The connected clients of e.g. a kernel manager, so that they can all be
+    stopped on shutdown.
+
+    Any clients still connected when the process exits are stopped by a
+    single exit hook for all registries.
+    """
+
+    def __init__(self) -> None:
+        self._clients: t.Set["ExecClient"] = set()
+        _registries.add(self)
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    def __contains__(self, client: "ExecClient") -> bool:
+        return client in self._clients
+
+    def add(self, client: "ExecClient") -> None:
+        self._clients.add(client)
+
+    def discard(self, client: "ExecClient") -> None:
+        self._clients.discard(client)
+
+    def close_all(self) -> None:
+        """Stop the channels of every client in the registry"""
+        clients, self._clients = self._clients, set()
+        for client in clients:
+            try:
+                client.close()
+            except Exception:
+                # E.g. the event loop is already closed at exit
+                client.log.debug("Failed to stop kernel client", exc_info=True)
+
+
+_registries: "weakref.WeakSet[ClientRegistry]" = weakref.WeakSet()
+
+
+@atexit.register
+def _close_all_clients() -> None:
+    for registry in list(_registries):
+        registry.close_all()
+
+
+# The registry of clients that are not given one:
+default_registry = ClientRegistry()
+
+
 class ExecClient(LoggingConfigurable):
     """
     A client for executing code on a Jupyter kernel
@@ -131,8 +260,33 @@ class ExecClient(LoggingConfigurable):
         ),
     ).tag(config=True)
 
+    max_stored_outputs: int = Integer(
+        0,
+        help=dedent(
+            """
+            The maximum number of outputs to keep when storing outputs. The
+            oldest outputs are dropped first. 0 for no limit.
+            """
+        ),
+    ).tag(config=True)
+
+    max_stored_output_bytes: int = Integer(
+        0,
+        help=dedent(
+            """
+            The maximum total size (in bytes) of the outputs to keep when
+            storing outputs. The oldest outputs are dropped first, except the
+            latest one. 0 for no limit.
+            """
+        ),
+    ).tag(config=True)
+
     def __init__(
-        self, km: KernelManager = None, _store_outputs: bool = False, **kw  # for testing purposes
+        self,
+        km: KernelManager = None,
+        _store_outputs: bool = False,  # for testing purposes
+        registry: t.Optional[ClientRegistry] = None,
+        **kw,
     ) -> None:
         """Initializes the execution manager.
 
@@ -141,17 +295,30 @@ class ExecClient(LoggingConfigurable):
         km : KernelManager (optional)
             Optional kernel manager. If none is provided, a kernel manager will
             be created.
+        registry : ClientRegistry (optional)
+            Where to register the client while it is connected. Defaults to
+            a process-wide registry.
         """
         super().__init__(**kw)
         self.km: KernelManager = km
+        self.registry = registry if registry is not None else default_registry
         self.kc: t.Optional[KernelClient] = None
+        # Mapping of msg_id -> _PendingExecution
+        self._pending: t.Dict[str, _PendingExecution] = {}
+        self._routers: t.Optional[t.List[asyncio.Future]] = None
+        self._watcher: t.Optional[asyncio.Future] = None
         self._store_outputs = _store_outputs
-        self._outputs = []
+        if self.max_stored_outputs or self.max_stored_output_bytes:
+            self._outputs = OutputBuffer(self.max_stored_outputs, self.max_stored_output_bytes)
+        else:
+            self._outputs = []
 
     async def cleanup_client(self) -> None:
+        await self._stop_routing()
         if getattr(self, "kc") and self.kc is not None:
             await ensure_async(self.kc.stop_channels())
             self.kc = None
+        self.registry.discard(self)
 
     async def _cleanup_kernel(self) -> None:
         assert self.km is not None
@@ -181,6 +348,7 @@ class ExecClient(LoggingConfigurable):
         """
         assert self.km is not None
         self.kc = self.km.client()
+        self.registry.add(self)
         await ensure_async(self.kc.start_channels())
         try:
             await ensure_async(self.kc.wait_for_ready(timeout=self.startup_timeout))
@@ -210,42 +378,23 @@ class ExecClient(LoggingConfigurable):
 
         When control returns from the yield it stops the client's zmq channels.
 
-        Handlers for SIGINT and SIGTERM are also added to cleanup in case of unexpected shutdown.
+        While connected, the client is kept in its registry, so that it is
+        stopped on shutdown.
         """
-
-        # self._sync_cleanup_kernel uses run_async, which ensures the ioloop is running again.
-        # This is necessary as the ioloop has stopped once atexit fires.
-        atexit.register(self._sync_cleanup_kernel)
-
-        def on_signal():
-            asyncio.ensure_future(self._cleanup_kernel())
-            atexit.unregister(self._sync_cleanup_kernel)
-
-        loop = asyncio.get_event_loop()
-        try:
-            loop.add_signal_handler(signal.SIGINT, on_signal)
-            loop.add_signal_handler(signal.SIGTERM, on_signal)
-        except (NotImplementedError, RuntimeError):
-            # NotImplementedError: Windows does not support signals.
-            # RuntimeError: Raised when add_signal_handler is called outside the main thread
-            pass
-
         try:
             await self.ensure_kernel_client()
             yield
         finally:
-            atexit.unregister(self._sync_cleanup_kernel)
-            try:
-                loop.remove_signal_handler(signal.SIGINT)
-                loop.remove_signal_handler(signal.SIGTERM)
-            except (NotImplementedError, RuntimeError):
-                pass
             await self.cleanup_client()
 
     async def execute(self, source: str, **kwargs) -> t.Optional[dict]:
         """
         Executes code. Requires that a setup_kernel context is held.
 
+        Several executions can be in flight at the same time, e.g. by
+        ``asyncio.gather``. The kernel runs them in the order they were
+        submitted.
+
         Parameters
         ----------
         source :
@@ -270,6 +419,36 @@ class ExecClient(LoggingConfigurable):
             with defaults about the failure.
         """
 
+        return await self._execute(source)
+
+    async def execute_stream(self, source: str) -> t.AsyncIterator[t.Dict]:
+        """
+        Executes code, yielding its outputs as they arrive. Requires that a
+        setup_kernel context is held.
+
+        The outputs are not stored. If the execution fails, the error output
+        is yielded before the error is raised.
+        """
+        outputs = _OutputQueue()
+        done = asyncio.ensure_future(self._execute(source, outputs))
+        try:
+            while True:
+                get = asyncio.ensure_future(outputs.queue.get())
+                await asyncio.wait([get, done], return_when=asyncio.FIRST_COMPLETED)
+                if get.done():
+                    yield get.result()
+                    continue
+                get.cancel()
+                # All outputs arrive before the execution completes
+                while not outputs.queue.empty():
+                    yield outputs.queue.get_nowait()
+                done.result()
+                return
+        finally:
+            if not done.done():
+                done.cancel()
+
+    async def _execute(self, source: str, outputs: t.Optional[t.Any] = None) -> t.Optional[dict]:
         assert self.kc is not None
         if not source.strip():
             self.log.debug("Skipping empty code")
@@ -283,92 +462,145 @@ class ExecClient(LoggingConfigurable):
                 store_history=False,
             )
         )
-        exec_timeout = self._get_timeout()
-
-        task_poll_kernel_alive = asyncio.ensure_future(self._poll_kernel_alive())
-        task_poll_output_msg = asyncio.ensure_future(self._poll_output_msg(parent_msg_id))
-        self.task_poll_for_reply = asyncio.ensure_future(
-            self._poll_for_reply(
-                parent_msg_id,
-                exec_timeout,
-                task_poll_output_msg,
-                task_poll_kernel_alive,
-            )
-        )
+        # Route the messages of the request before anything else can run
+        pending = _PendingExecution(outputs)
+        self._pending[parent_msg_id] = pending
+        self._start_routing()
         try:
-            exec_reply = await self.task_poll_for_reply
-        except asyncio.CancelledError:
-            # can only be cancelled by task_poll_kernel_alive when the kernel is dead
-            task_poll_output_msg.cancel()
-            raise DeadKernelError("Kernel died")
-        except Exception as e:
-            # Best effort to cancel request if it hasn't been resolved
-            try:
-                # Check if the task_poll_output is doing the raising for us
-                if not isinstance(e, ControlSignal):
-                    task_poll_output_msg.cancel()
-            finally:
-                raise
+            exec_reply = await self._wait_for_reply(pending, self._get_timeout())
+        finally:
+            self._pending.pop(parent_msg_id, None)
 
         self._check_raise_for_error(exec_reply)
         return exec_reply
 
-    async def _poll_for_reply(
-        self,
-        msg_id: str,
-        timeout: t.Optional[int],
-        task_poll_output_msg: asyncio.Future,
-        task_poll_kernel_alive: asyncio.Future,
-    ) -> t.Dict:
+    async def execute_many(self, sources: t.Iterable[str]) -> t.List[t.Optional[dict]]:
+        """
+        Executes several code blocks, submitting each without waiting for
+        the reply to the previous one. Requires that a setup_kernel context
+        is held.
 
-        assert self.kc is not None
-        new_timeout: t.Optional[float] = None
-        if timeout is not None:
-            deadline = monotonic() + timeout
-            new_timeout = float(timeout)
+        Returns the execute reply messages, or raises the error of the
+        first block that failed.
+        """
+        results = await asyncio.gather(
+            *(self.execute(source) for source in sources), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    async def _wait_for_reply(
+        self, pending: "_PendingExecution", timeout: t.Optional[int]
+    ) -> t.Dict:
         while True:
             try:
-                msg = await ensure_async(self.kc.shell_channel.get_msg(timeout=new_timeout))
-                if msg["parent_header"].get("msg_id") == msg_id:
-                    try:
-                        await asyncio.wait_for(task_poll_output_msg, self.iopub_timeout)
-                    except (asyncio.TimeoutError, Empty):
-                        if self.raise_on_iopub_timeout:
-                            task_poll_kernel_alive.cancel()
-                            raise ExecTimeoutError("Timeout waiting for IOPub output")
-                        else:
-                            self.log.warning("Timeout waiting for IOPub output")
-                    task_poll_kernel_alive.cancel()
-                    return msg
-                else:
-                    if new_timeout is not None:
-                        new_timeout = max(0, deadline - monotonic())
-            except Empty:
-                # received no message, check if kernel is still alive
-                assert timeout is not None
-                task_poll_kernel_alive.cancel()
+                msg = await asyncio.wait_for(asyncio.shield(pending.reply), timeout)
+                break
+            except asyncio.TimeoutError:
                 await self._check_alive()
                 await self._handle_timeout(timeout)
+        if msg["content"].get("status") == "aborted":
+            # The request was not run, so there is no output to wait for
+            return msg
+        try:
+            await asyncio.wait_for(asyncio.shield(pending.idle), self.iopub_timeout)
+        except asyncio.TimeoutError:
+            if self.raise_on_iopub_timeout:
+                raise ExecTimeoutError("Timeout waiting for IOPub output")
+            else:
+                self.log.warning("Timeout waiting for IOPub output")
+        return msg
+
+    def _start_routing(self) -> None:
+        """Start the readers that route kernel messages to pending executions, if needed"""
+        if self._routers is None:
+            self._routers = [
+                asyncio.ensure_future(self._route_shell()),
+                asyncio.ensure_future(self._route_iopub()),
+            ]
+            for task in self._routers:
+                task.add_done_callback(self._on_router_done)
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.ensure_future(self._watch_kernel())
+
+    def _on_router_done(self, task: asyncio.Future) -> None:
+        if task.cancelled() or task.exception() is None:
+            return
+        self.log.error("Failed to read kernel messages", exc_info=task.exception())
+        if self._routers is not None and task in self._routers:
+            # Stop the other router too, so that the next execute restarts both
+            for router in self._routers:
+                router.cancel()
+            self._routers = None
+        self._fail_pending(task.exception())
+
+    def _cancel_routing(self) -> t.List[asyncio.Future]:
+        tasks = (self._routers or []) + ([self._watcher] if self._watcher else [])
+        self._routers = self._watcher = None
+        for task in tasks:
+            task.cancel()
+        self._fail_pending(DeadKernelError("Kernel client stopped"))
+        return tasks
+
+    async def _stop_routing(self) -> None:
+        await asyncio.gather(*self._cancel_routing(), return_exceptions=True)
+
+    def close(self) -> None:
+        """Stop the client without waiting, e.g. from synchronous code"""
+        self._cancel_routing()
+        if self.kc is not None:
+            self.kc.stop_channels()
+            self.kc = None
+        self.registry.discard(self)
 
-    async def _poll_output_msg(self, parent_msg_id: str) -> None:
-
+    async def _route_shell(self) -> None:
         assert self.kc is not None
         while True:
-            msg = await ensure_async(self.kc.iopub_channel.get_msg(timeout=None))
-            if msg["parent_header"].get("msg_id") == parent_msg_id:
-                if self.process_message(msg):
-                    return
+            msg = await ensure_async(self.kc.shell_channel.get_msg(timeout=None))
+            pending = self._pending.get(msg["parent_header"].get("msg_id"))
+            if pending is not None and not pending.reply.done():
+                pending.reply.set_result(msg)
 
-    async def _poll_kernel_alive(self) -> None:
+    async def _route_iopub(self) -> None:
+        assert self.kc is not None
         while True:
-            await asyncio.sleep(1)
+            msg = await ensure_async(self.kc.iopub_channel.get_msg(timeout=None))
+            pending = self._pending.get(msg["parent_header"].get("msg_id"))
+            if pending is None or pending.idle.done():
+                continue
+            try:
+                if self.process_message(msg, pending.outputs):
+                    pending.idle.set_result(None)
+            except Exception as e:
+                # Fail the execution the message belongs to, not the router
+                pending.idle.set_exception(e)
+                if not pending.reply.done():
+                    pending.reply.set_exception(e)
+
+    async def _watch_kernel(self) -> None:
+        """Fail all pending executions if the kernel dies"""
+        while self._pending:
+            if self.km is not None:
+                # Returns as soon as the kernel process exits, where supported
+                await wait_for_exit(self.km)
+            else:
+                await asyncio.sleep(1)
             try:
                 await self._check_alive()
-            except DeadKernelError:
-                assert self.task_poll_for_reply is not None
-                self.task_poll_for_reply.cancel()
+            except DeadKernelError as e:
+                self._fail_pending(e)
                 return
 
+    def _fail_pending(self, error: Exception) -> None:
+        for pending in self._pending.values():
+            for future in (pending.reply, pending.idle):
+                if not future.done():
+                    future.set_exception(error)
+                    # Avoid warnings about exceptions that nobody retrieves
+                    future.exception()
+
     def _get_timeout(self) -> int:
         timeout = self.timeout
 
@@ -404,7 +636,7 @@ class ExecClient(LoggingConfigurable):
 
         raise ExecutionError.from_msg(exec_reply_content)
 
-    def process_message(self, msg: t.Dict) -> bool:
+    def process_message(self, msg: t.Dict, outs: t.Optional[t.Any] = None) -> bool:
         """
         Processes a kernel message, updates cell state, and returns the
         resulting output object that was appended to cell.outputs.
@@ -415,6 +647,8 @@ class ExecClient(LoggingConfigurable):
         ----------
         msg : dict
             The kernel message being processed.
+        outs : list-like (optional)
+            Where to append any output, instead of the stored outputs.
 
         Returns
         -------
@@ -427,20 +661,20 @@ class ExecClient(LoggingConfigurable):
         if msg_type == "status":
             if content["execution_state"] == "idle":
                 return True
-        elif self._store_outputs and msg_type not in [
+        elif (outs is not None or self._store_outputs) and msg_type not in [
             "clear_output",
             "comm",
             "execute_input",
             "update_display_data",
         ]:
             # Assign output as our processed "result"
-            self.output(self._outputs, msg)
+            self.output(self._outputs if outs is None else outs, msg)
         return False
 
     def output(self, outs: t.List, msg: t.Dict) -> t.Optional[t.List]:
 
         try:
-            out = output_from_msg(msg)
+            out = _output_from_msg(msg)
         except ValueError:
             self.log.error("unhandled iopub msg: " + msg["msg_type"])
             return
@@ -0,0 +1,76 @@
+# coding: utf-8
+
+# Copyright (c) Vidar Tonaas Fauske.
+# Distributed under the terms of the Modified BSD License.
+"""Hotpot - Jupyter kernel manager helpers
+
+This module contains a cache of the kernel_pool_init files used to
+initialize pooled kernels.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+
+
+class InitFileCache:
+    """Caches the contents of kernel_pool_init_{kernel_name}.{extension} files.
+
+    The files are looked for in the Jupyter config path once per kernel name,
+    and read again only when a file appears, disappears or is modified.
+    """
+
+    def __init__(self):
+        # Mapping of (kernel name, extension) -> candidate paths
+        self._paths = {}
+        # Mapping of (kernel name, extension) -> (stamp, scripts, digest)
+        self._loaded = {}
+
+    def _candidates(self, key):
+        paths = self._paths.get(key)
+        if paths is None:
+            from jupyter_core.paths import jupyter_config_path
+
+            kernel_name, extension = key
+            paths = self._paths[key] = [
+                Path(base) / f"kernel_pool_init_{kernel_name}.{extension}"
+                for base in jupyter_config_path()
+            ]
+        return paths
+
+    def get(self, kernel_name, extension):
+        """Get the init scripts of a kernel, and a digest of their contents.
+
+        Returns
+        -------
+        A tuple of a list of (path, code) tuples, in the order they should be
+        run, and a string that changes whenever the code does.
+        """
+        key = (kernel_name, extension)
+        stamp = []
+        for path in self._candidates(key):
+            try:
+                stamp.append((path, os.stat(path).st_mtime_ns))
+            except OSError:
+                pass
+        cached = self._loaded.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1], cached[2]
+
+        scripts = []
+        digest = hashlib.sha1()
+        for path, _ in stamp:
+            try:
+                with open(path) as f:
+                    code = f.read()
+            except OSError:
+                continue
+            scripts.append((path, code))
+            digest.update(str(path).encode() + b"\0" + code.encode() + b"\0")
+        self._loaded[key] = (stamp, scripts, digest.hexdigest())
+        return scripts, digest.hexdigest()
+
+
+__all__ = [
+    "InitFileCache",
+]
@@ -0,0 +1,175 @@
+# coding: utf-8
+
+# Copyright (c) Vidar Tonaas Fauske.
+# Distributed under the terms of the Modified BSD License.
+"""Hotpot - Jupyter kernel manager helpers
+
+This module contains the bookkeeping for pooled kernels.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+from time import monotonic
+
+
+# start_kernel arguments that can be changed in a running kernel:
+ADAPTABLE_KWARGS = ("path", "cwd", "env")
+
+
+def kwargs_fingerprint(kwargs, exclude=()):
+    """A hash of start_kernel arguments, which is the same for equal arguments"""
+    canonical = json.dumps(
+        {k: v for k, v in kwargs.items() if k not in exclude}, sort_keys=True, default=repr
+    )
+    return hashlib.sha1(canonical.encode()).hexdigest()
+
+
+class PoolEntry:
+    """A kernel in a pool, which might still be starting up.
+
+    Awaiting the entry gives the kernel id once the kernel is ready.
+    """
+
+    def __init__(self, kernel_name):
+        self.kernel_name = kernel_name
+        self.created = monotonic()
+        # Set once the kernel is ready for use:
+        self.ready_at = None
+        # Set once the kernel has been launched:
+        self.kernel_id = None
+        self.task = None
+        # Whether the kernel was automatically restarted, and so lost its initialization:
+        self.restarted = False
+        # The entry this is a replacement for, while recycling:
+        self.replaces = None
+        # Digest of the kernel_pool_init files the kernel was initialized with:
+        self.init_digest = None
+        # Digest of the configuration the kernel was started and initialized with:
+        self.config_digest = None
+        # A connected ExecClient, kept until the kernel is handed out:
+        self.client = None
+        # The NotebookPool the kernel is prewarmed for, if any:
+        self.notebook = None
+        # The PoolVariant the kernel was started for, if any:
+        self.variant = None
+        # A task that notices if the kernel process exits while pooled:
+        self.watcher = None
+
+    def __await__(self):
+        return self.task.__await__()
+
+    def stop_watching(self):
+        """Cancel the task watching for the kernel process to exit, if any"""
+        watcher, self.watcher = self.watcher, None
+        if watcher is not None:
+            watcher.cancel()
+
+    def close_client(self):
+        """Stop the channels of the client kept for the kernel, if any"""
+        client, self.client = self.client, None
+        if client is not None:
+            client.close()
+
+
+class KernelPool:
+    """The entries of a kernel pool, ordered by how soon they can be used.
+
+    Entries are handed out ready first, in the order they became ready, then
+    still starting, in the order they were launched, and lastly failed ones.
+    All operations are O(1).
+    """
+
+    def __init__(self):
+        # Insertion ordered sets of entries:
+        self._ready = OrderedDict()
+        self._starting = OrderedDict()
+        self._failed = OrderedDict()
+
+    def __len__(self):
+        return len(self._ready) + len(self._starting) + len(self._failed)
+
+    def __iter__(self):
+        yield from tuple(self._ready)
+        yield from tuple(self._starting)
+        yield from tuple(self._failed)
+
+    def __contains__(self, entry):
+        return entry in self._ready or entry in self._starting or entry in self._failed
+
+    def ready(self):
+        """The entries that are ready for use, in the order they became ready"""
+        return tuple(self._ready)
+
+    def count_ready(self):
+        return len(self._ready)
+
+    def add(self, entry):
+        """Add an entry whose task has been started"""
+        self._starting[entry] = None
+        entry.task.add_done_callback(lambda task: self._on_done(entry))
+
+    def _on_done(self, entry):
+        if entry not in self._starting:
+            # No longer in the pool
+            return
+        del self._starting[entry]
+        task = entry.task
+        if task.cancelled() or task.exception() is not None:
+            self._failed[entry] = None
+        else:
+            self._ready[entry] = None
+
+    def pop(self):
+        """Remove and return the entry that can be used the soonest"""
+        for entries in (self._ready, self._starting, self._failed):
+            if entries:
+                return entries.popitem(last=False)[0]
+        raise IndexError("pop from empty pool")
+
+    def pop_last(self):
+        """Remove and return the entry that would be handed out last"""
+        for entries in (self._failed, self._starting, self._ready):
+            if entries:
+                return entries.popitem(last=True)[0]
+        raise IndexError("pop from empty pool")
+
+    def remove(self, entry):
+        """Remove an entry, if present"""
+        for entries in (self._ready, self._starting, self._failed):
+            if entries.pop(entry, False) is None:
+                return
+
+
+class PoolVariant:
+    """A pool of kernels of a kernel name, that are started with specific arguments"""
+
+    def __init__(self, kernel_name, kwargs, size=0):
+        self.kernel_name = kernel_name
+        self.kwargs = kwargs
+        self.size = size
+        self.fingerprint = kwargs_fingerprint(kwargs)
+        # The fingerprint of the arguments that cannot be adapted later:
+        self.base_fingerprint = kwargs_fingerprint(kwargs, ADAPTABLE_KWARGS)
+        self.pool = KernelPool()
+
+    def adaptation_cost(self, kwargs):
+        """The number of adaptations needed for a kernel to match kwargs"""
+        cost = 0
+        for key in ("path", "cwd"):
+            if kwargs.get(key) != self.kwargs.get(key):
+                cost += 1
+        env = self.kwargs.get("env") or {}
+        for key, value in (kwargs.get("env") or {}).items():
+            if env.get(key) != value:
+                cost += 1
+        return cost
+
+
+__all__ = [
+    "ADAPTABLE_KWARGS",
+    "KernelPool",
+    "PoolEntry",
+    "PoolVariant",
+    "kwargs_fingerprint",
+]
@@ -7,47 +7,340 @@
 This module contains
 """
 
+import threading
+from collections import Counter, deque
+from contextlib import nullcontext
+from time import monotonic
+
 from jupyter_client.multikernelmanager import MultiKernelManager
 
-from traitlets import Integer
+from traitlets import Any, Dict, Float, Integer, Unicode
+from traitlets.config.configurable import LoggingConfigurable
+
+from .memory import kernel_pid, memory_supported, process_tree_rss
 
 
 class MaximumKernelsException(Exception):
     pass
 
 
-class SyncLimitedKernelManager(MultiKernelManager):
+class KernelQuotaException(MaximumKernelsException):
+    pass
+
+
+def _admission_metrics(stats, queued, active, reserved):
+    metrics = dict(stats, queued=queued, active=active, reserved=reserved)
+    waits = stats["admitted"] + stats["timeouts"]
+    metrics["wait_mean"] = stats["wait_total"] / waits if waits else 0.0
+    return metrics
+
+
+def _estimate_memory(sample, kernel_ids, reserved):
+    """Estimate the total memory use of kernels from a sample, or None if unknown.
+
+    Kernels missing from the sample, and those being started, are assumed to
+    use the average amount.
+    """
+    if not sample:
+        return None
+    measured = [sample[kid] for kid in kernel_ids if kid in sample]
+    if not measured:
+        return None
+    used = sum(measured)
+    return used + (len(kernel_ids) - len(measured) + reserved) * used / len(measured)
+
+
+class KernelLimitsMixin(LoggingConfigurable):
+    """The limits and quotas shared by the sync and async limited managers.
+
+    Subclasses provide the admission of start requests, and set
+    _admission_lock to guard the shared state.
+    """
+
     max_kernels = Integer(
         0,
         config=True,
         help="The maximum number of concurrent kernels",
     )
 
+    max_kernels_wait = Float(
+        0,
+        config=True,
+        help="Time in seconds a request to start a kernel waits for capacity when max_kernels "
+        "is reached, before failing (0 to fail immediately). Waiting requests are served "
+        "in order. For the sync manager, capacity can only be freed by other threads.",
+    )
+
+    max_memory = Integer(
+        0,
+        config=True,
+        help="The maximum total resident memory in bytes of all kernels, including their child "
+        "processes (0 for no limit). This is only enforced on platforms with /proc.",
+    )
+
+    memory_sample_interval = Float(
+        5,
+        config=True,
+        help="The minimum time in seconds between measurements of kernel memory use",
+    )
+
+    max_kernels_per_name = Dict(
+        key_trait=Unicode(),
+        value_trait=Integer(),
+        config=True,
+        help="The maximum number of concurrent kernels started by users for each kernel name. "
+        "Kernels waiting in a pool do not count until they are handed out.",
+    )
+
+    max_kernels_per_owner = Integer(
+        0,
+        config=True,
+        help="The maximum number of concurrent kernels for each owner (0 for no limit). "
+        "Kernels waiting in a pool do not count until they are handed out.",
+    )
+
+    kernel_owner_kwarg = Unicode(
+        "owner",
+        config=True,
+        help="The start_kernel keyword argument that identifies the owner of a kernel. "
+        "It is removed before the kernel is launched.",
+    )
+
+    kernel_owner = Any(
+        None,
+        allow_none=True,
+        config=True,
+        help="A callable taking the kernel name and start_kernel kwargs, and returning the owner "
+        "of the kernel, or None. If unset, the owner is taken from the kernel_owner_kwarg.",
+    )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._admission_lock = nullcontext()
+        self._admission_queue = deque()
+        # The number of kernels being started, that are not yet counted by len(self)
+        self._reserved = 0
+        self._admission_stats = Counter(admitted=0, timeouts=0, wait_total=0.0, wait_max=0.0)
+        self._memory_sample = None
+        self._memory_sampled_at = 0
+        self._name_counts = Counter()
+        self._owner_counts = Counter()
+        # Mapping of kernel_id -> (kernel name, owner) for kernels counted by the quotas
+        self._quota_keys = {}
+
+    def _at_capacity(self):
+        return len(self) + self._reserved >= self.max_kernels > 0 or self._memory_exceeded()
+
+    def _kernel_pids(self):
+        return {kid: kernel_pid(self.get_kernel(kid)) for kid in self.list_kernel_ids()}
+
+    def get_kernel_memory(self):
+        """Get the resident memory in bytes of each kernel, including its child processes.
+
+        This is measured at most every memory_sample_interval seconds, so
+        recently started kernels can be missing. Returns None if this is not
+        supported on the platform.
+        """
+        now = monotonic()
+        if (
+            self._memory_sample is None
+            or now - self._memory_sampled_at >= self.memory_sample_interval
+        ):
+            self._memory_sample = process_tree_rss(self._kernel_pids())
+            self._memory_sampled_at = now
+        return self._memory_sample
+
+    def _record_wait(self, start, outcome):
+        waited = monotonic() - start
+        stats = self._admission_stats
+        stats[outcome] += 1
+        stats["wait_total"] += waited
+        stats["wait_max"] = max(stats["wait_max"], waited)
+
+    def get_admission_metrics(self):
+        """Get the number of queued start requests, and statistics of their wait times"""
+        with self._admission_lock:
+            return _admission_metrics(
+                self._admission_stats, len(self._admission_queue), len(self), self._reserved
+            )
+
+    def _kernel_owner(self, kernel_name, kwargs):
+        """Get the owner of a kernel to be started, removing it from the kwargs"""
+        if self.kernel_owner is not None:
+            owner = self.kernel_owner(kernel_name, kwargs)
+        else:
+            owner = kwargs.get(self.kernel_owner_kwarg)
+        kwargs.pop(self.kernel_owner_kwarg, None)
+        return owner
+
+    def _claim_quota(self, kernel_name, owner):
+        name_limit = self.max_kernels_per_name.get(kernel_name, 0)
+        with self._admission_lock:
+            if 0 < name_limit <= self._name_counts[kernel_name]:
+                self.log.debug("Refusing to start kernel, quota reached for %s.", kernel_name)
+                raise KernelQuotaException("No %s kernels are available." % (kernel_name,))
+            if owner is not None and 0 < self.max_kernels_per_owner <= self._owner_counts[owner]:
+                self.log.debug("Refusing to start kernel, quota reached for owner %s.", owner)
+                raise KernelQuotaException("No kernels are available for %s." % (owner,))
+            self._name_counts[kernel_name] += 1
+            if owner is not None:
+                self._owner_counts[owner] += 1
+
+    def _release_quota(self, kernel_name, owner):
+        with self._admission_lock:
+            for counts, key in ((self._name_counts, kernel_name), (self._owner_counts, owner)):
+                if key is not None:
+                    counts[key] -= 1
+                    if counts[key] <= 0:
+                        del counts[key]
+
+    def get_kernel_owner(self, kernel_id):
+        """Get the owner of a kernel, if any"""
+        return self._quota_keys.get(kernel_id, (None, None))[1]
+
+
+class SyncLimitedKernelManager(KernelLimitsMixin, MultiKernelManager):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._admission_cond = self._admission_lock = threading.Condition()
+
+    def _memory_exceeded(self):
+        if self.max_memory <= 0:
+            return False
+        used = _estimate_memory(self.get_kernel_memory(), self.list_kernel_ids(), self._reserved)
+        return used is not None and used >= self.max_memory
+
+    def _try_reserve_capacity(self):
+        """Reserve capacity for starting a kernel, or raise if that requires waiting"""
+        with self._admission_cond:
+            if self._admission_queue or self._at_capacity():
+                raise MaximumKernelsException("No kernels are available.")
+            self._reserved += 1
+
+    def _reserve_capacity(self):
+        """Reserve capacity for starting a kernel, waiting in line if needed"""
+        with self._admission_cond:
+            if not self._admission_queue and not self._at_capacity():
+                self._reserved += 1
+                return
+            if self.max_kernels_wait <= 0:
+                self.log.debug("Refusing to start kernel, maximum number reached.")
+                raise MaximumKernelsException("No kernels are available.")
+            ticket = object()
+            self._admission_queue.append(ticket)
+            start = monotonic()
+            deadline = start + self.max_kernels_wait
+            try:
+                while self._admission_queue[0] is not ticket or self._at_capacity():
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        self._record_wait(start, "timeouts")
+                        self.log.debug("Refusing to start kernel, timed out waiting for capacity.")
+                        raise MaximumKernelsException("No kernels are available.")
+                    if self.max_memory > 0:
+                        # Check again once memory is measured again
+                        remaining = min(remaining, self.memory_sample_interval)
+                    self._admission_cond.wait(remaining)
+            finally:
+                self._admission_queue.remove(ticket)
+                # Let the next in line check
+                self._admission_cond.notify_all()
+            self._reserved += 1
+            self._record_wait(start, "admitted")
+
+    def _release_capacity(self, reserved=True):
+        """Release a reservation once the kernel is counted by len(self), or failed to start"""
+        with self._admission_cond:
+            if reserved:
+                self._reserved -= 1
+            self._admission_cond.notify_all()
+
     def start_kernel(self, kernel_name=None, **kwargs):
-        if "kernel_id" not in kwargs and len(self) >= self.max_kernels > 0:
-            self.log.debug("Refusing to start kernel, maximum number reached.")
-            raise MaximumKernelsException("No kernels are available.")
-        return super().start_kernel(kernel_name=kernel_name, **kwargs)
+        if kwargs.get("kernel_id") in self:
+            kwargs.pop(self.kernel_owner_kwarg, None)
+            return super().start_kernel(kernel_name=kernel_name, **kwargs)
+        if kernel_name is None:
+            kernel_name = self.default_kernel_name
+        owner = self._kernel_owner(kernel_name, kwargs)
+        self._claim_quota(kernel_name, owner)
+        try:
+            kernel_id = self._start_claimed_kernel(kernel_name, kwargs)
+        except BaseException:
+            self._release_quota(kernel_name, owner)
+            raise
+        self._quota_keys[kernel_id] = (kernel_name, owner)
+        return kernel_id
+
+    def _start_claimed_kernel(self, kernel_name, kwargs):
+        """Start a kernel once it has been counted by the quotas"""
+        self._reserve_capacity()
+        try:
+            return super().start_kernel(kernel_name=kernel_name, **kwargs)
+        finally:
+            self._release_capacity()
+
+    def remove_kernel(self, kernel_id):
+        km = super().remove_kernel(kernel_id)
+        key = self._quota_keys.pop(kernel_id, None)
+        if key is not None:
+            self._release_quota(*key)
+        self._release_capacity(reserved=False)
+        return km
 
 
 __all__ = [
+    "KernelQuotaException",
     "MaximumKernelsException",
     "SyncLimitedKernelManager",
 ]
 
 
 try:
+    import asyncio
+
     from jupyter_client.multikernelmanager import (
         AsyncMultiKernelManager,
         MultiKernelManager,
     )
 
-    class LimitedKernelManager(AsyncMultiKernelManager):
-        max_kernels = Integer(
-            0,
-            config=True,
-            help="The maximum number of concurrent kernels",
-        )
+    class LimitedKernelManager(KernelLimitsMixin, AsyncMultiKernelManager):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            # Task that measures kernel memory every memory_sample_interval
+            self._memory_sampler = None
+
+        def _memory_exceeded(self):
+            if self.max_memory <= 0:
+                return False
+            # Measuring is too slow for every admission, so use the latest sample
+            used = _estimate_memory(self._memory_sample, self.list_kernel_ids(), self._reserved)
+            return used is not None and used >= self.max_memory
+
+        def _start_memory_sampling(self):
+            if self.max_memory > 0 and self._memory_sampler is None and memory_supported():
+                loop = asyncio.get_event_loop()
+                self._memory_sampler = loop.create_task(self._sample_memory())
+
+        async def _sample_memory(self):
+            """Measure kernel memory every memory_sample_interval, off the event loop"""
+            loop = asyncio.get_event_loop()
+            while True:
+                try:
+                    sample = await loop.run_in_executor(None, process_tree_rss, self._kernel_pids())
+                    self._memory_sample = sample
+                    self._memory_sampled_at = monotonic()
+                    # Memory might have been freed
+                    self._admit_waiters()
+                except Exception:
+                    self.log.exception("Failed to measure kernel memory")
+                await asyncio.sleep(self.memory_sample_interval)
+
+        def _try_reserve_capacity(self):
+            """Reserve capacity for starting a kernel, or raise if that requires waiting"""
+            self._start_memory_sampling()
+            if self._admission_queue or self._at_capacity():
+                raise MaximumKernelsException("No kernels are available.")
+            self._reserved += 1
 
         def pre_start_kernel(self, kernel_name, kwargs):
             if len(self) >= self.max_kernels > 0:
@@ -55,6 +348,99 @@ try:
                 raise MaximumKernelsException("No kernels are available.")
             return super().pre_start_kernel(kernel_name, kwargs)
 
+        async def _reserve_capacity(self):
+            """Reserve capacity for starting a kernel, waiting in line if needed"""
+            self._start_memory_sampling()
+            if not self._admission_queue and not self._at_capacity():
+                self._reserved += 1
+                return
+            if self.max_kernels_wait <= 0:
+                self.log.debug("Refusing to start kernel, maximum number reached.")
+                raise MaximumKernelsException("No kernels are available.")
+
+            loop = asyncio.get_event_loop()
+            waiter = loop.create_future()
+            self._admission_queue.append(waiter)
+            self._admit_waiters()
+            start = monotonic()
+
+            def on_timeout():
+                if not waiter.done():
+                    self._admission_queue.remove(waiter)
+                    waiter.set_exception(MaximumKernelsException("No kernels are available."))
+
+            timer = loop.call_later(self.max_kernels_wait, on_timeout)
+            try:
+                await waiter
+            except MaximumKernelsException:
+                self._record_wait(start, "timeouts")
+                self.log.debug("Refusing to start kernel, timed out waiting for capacity.")
+                raise
+            except asyncio.CancelledError:
+                if waiter in self._admission_queue:
+                    self._admission_queue.remove(waiter)
+                elif not waiter.cancelled() and waiter.exception() is None:
+                    # We were admitted, so pass on the capacity
+                    self._release_capacity()
+                raise
+            finally:
+                timer.cancel()
+            self._record_wait(start, "admitted")
+
+        def _admit_waiters(self):
+            queue = self._admission_queue
+            while queue and not self._at_capacity():
+                waiter = queue.popleft()
+                if waiter.done():
+                    # Cancelled, but not yet removed by its request
+                    continue
+                # Reserve on behalf of the waiter:
+                self._reserved += 1
+                waiter.set_result(None)
+
+        def _release_capacity(self):
+            """Release a reservation once the kernel is counted by len(self), or failed to start"""
+            self._reserved -= 1
+            self._admit_waiters()
+
+        async def start_kernel(self, kernel_name=None, **kwargs):
+            if kwargs.get("kernel_id") in self:
+                kwargs.pop(self.kernel_owner_kwarg, None)
+                return await super().start_kernel(kernel_name=kernel_name, **kwargs)
+            if kernel_name is None:
+                kernel_name = self.default_kernel_name
+            owner = self._kernel_owner(kernel_name, kwargs)
+            self._claim_quota(kernel_name, owner)
+            try:
+                kernel_id = await self._start_claimed_kernel(kernel_name, kwargs)
+            except BaseException:
+                self._release_quota(kernel_name, owner)
+                raise
+            self._quota_keys[kernel_id] = (kernel_name, owner)
+            return kernel_id
+
+        async def _start_claimed_kernel(self, kernel_name, kwargs):
+            """Start a kernel once it has been counted by the quotas"""
+            await self._reserve_capacity()
+            try:
+                return await super().start_kernel(kernel_name=kernel_name, **kwargs)
+            finally:
+                self._release_capacity()
+
+        def remove_kernel(self, kernel_id):
+            km = super().remove_kernel(kernel_id)
+            key = self._quota_keys.pop(kernel_id, None)
+            if key is not None:
+                self._release_quota(*key)
+            self._admit_waiters()
+            return km
+
+        async def shutdown_all(self, now=False):
+            if self._memory_sampler is not None:
+                self._memory_sampler.cancel()
+                self._memory_sampler = None
+            await super().shutdown_all(now=now)
+
     __all__.append("LimitedKernelManager")
 
 except ImportError:
@@ -1,6 +1,5 @@
 from jupyter_server.services.kernels.kernelmanager import AsyncMappingKernelManager
 
-from .limited import MaximumKernelsException
 from .pooled import PooledKernelManager
 
 
@@ -12,14 +11,6 @@ class PooledMappingKernelManager(PooledKernelManager, AsyncMappingKernelManager)
 
     async def cull_kernel_if_idle(self, kernel_id):
         # Ensure we don't cull pooled kernels:
-        # (this logic assumes the init time is shorter than the cull time)
-        for pool in self._pools.values():
-            for i, f in enumerate(pool):
-                try:
-                    if f.done() and f.result() == kernel_id:
-                        return
-                except Exception as e:
-                    if not isinstance(e, MaximumKernelsException):
-                        self.log.exception("Kernel failed starting up")
-                    pool.pop(i)
+        if kernel_id in self._pooled_kernels:
+            return
         return await super().cull_kernel_if_idle(kernel_id)
@@ -15,14 +15,12 @@ class SyncPooledMappingKernelManager(SyncPooledKernelManager, MappingKernelManag
     if asyncio.iscoroutinefunction(MappingKernelManager.cull_kernel_if_idle):
         async def cull_kernel_if_idle(self, kernel_id):
             # Ensure we don't cull pooled kernels:
-            for pool in self._pools.values():
-                if kernel_id in pool:
-                    return
+            if kernel_id in self._pooled_kernels:
+                return
             return await super().cull_kernel_if_idle(kernel_id)
     else:
         def cull_kernel_if_idle(self, kernel_id):
             # Ensure we don't cull pooled kernels:
-            for pool in self._pools.values():
-                if kernel_id in pool:
-                    return
+            if kernel_id in self._pooled_kernels:
+                return
             return super().cull_kernel_if_idle(kernel_id)
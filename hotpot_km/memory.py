@@ -0,0 +1,85 @@
+# coding: utf-8
+
+# Copyright (c) Vidar Tonaas Fauske.
+# Distributed under the terms of the Modified BSD License.
+"""Hotpot - Jupyter kernel manager helpers
+
+This module contains helpers for measuring the memory use of kernels.
+"""
+
+import os
+from collections import defaultdict
+
+
+def memory_supported():
+    """Whether process memory can be read on this platform"""
+    return os.path.isdir("/proc/self")
+
+
+def _read_processes():
+    """Get a mapping of pid -> (parent pid, resident memory in bytes) of all processes"""
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    processes = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", "rb") as f:
+                stat = f.read()
+        except OSError:
+            # The process has exited
+            continue
+        # The command name can contain spaces and parentheses, so skip past the last ")"
+        fields = stat[stat.rindex(b")") + 2 :].split()
+        processes[int(name)] = (int(fields[1]), int(fields[21]) * page_size)
+    return processes
+
+
+def process_tree_rss(pids):
+    """Get the resident memory of processes, including all their descendants.
+
+    Parameters
+    ----------
+    pids : dict
+        Mapping of an arbitrary key to a process id.
+
+    Returns
+    -------
+    A mapping of the same keys to the resident memory in bytes, or None if
+    this is not supported on the platform. Processes that are not found are
+    reported as using no memory.
+    """
+    if not memory_supported():
+        return None
+    processes = _read_processes()
+    children = defaultdict(list)
+    for pid, (ppid, rss) in processes.items():
+        children[ppid].append(pid)
+
+    result = {}
+    for key, pid in pids.items():
+        total = 0
+        stack = [pid] if pid in processes else []
+        while stack:
+            pid = stack.pop()
+            total += processes[pid][1]
+            stack.extend(children[pid])
+        result[key] = total
+    return result
+
+
+def kernel_pid(km):
+    """Get the process id of a kernel started by a kernel manager, if any"""
+    provisioner = getattr(km, "provisioner", None)
+    if provisioner is not None:
+        process = getattr(provisioner, "process", None)
+    else:
+        process = getattr(km, "kernel", None)
+    return getattr(process, "pid", None)
+
+
+__all__ = [
+    "kernel_pid",
+    "memory_supported",
+    "process_tree_rss",
+]
@@ -0,0 +1,56 @@
+# coding: utf-8
+
+# Copyright (c) Vidar Tonaas Fauske.
+# Distributed under the terms of the Modified BSD License.
+"""Hotpot - Jupyter kernel manager helpers
+
+This module contains the bookkeeping for kernels prewarmed for a notebook.
+"""
+
+import os
+
+from .kernel_pool import KernelPool
+
+
+def notebook_stamp(path):
+    """Get a value that changes when a notebook file changes, or None if it is missing"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def read_prewarm_cells(path, tag):
+    """Get the sources of the code cells of a notebook that are tagged with tag"""
+    import nbformat
+
+    nb = nbformat.read(path, as_version=4)
+    return [
+        cell.source
+        for cell in nb.cells
+        if cell.cell_type == "code" and tag in cell.metadata.get("tags", ())
+    ]
+
+
+class NotebookPool:
+    """The pooled kernels of a notebook, which have run its prewarm cells"""
+
+    def __init__(self, path, kernel_name, stamp, cells):
+        self.path = path
+        self.kernel_name = kernel_name
+        # The notebook_stamp the cells were read at:
+        self.stamp = stamp
+        self.cells = cells
+        self.pool = KernelPool()
+
+    def initialization_stages(self):
+        """The (name, code) initialization stages that run the prewarm cells"""
+        return [("%s [cell %d]" % (self.path, i), code) for i, code in enumerate(self.cells)]
+
+
+__all__ = [
+    "NotebookPool",
+    "notebook_stamp",
+    "read_prewarm_cells",
+]
@@ -8,20 +8,43 @@ This module contains
 """
 
 import asyncio
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+from itertools import chain
+import os
+from time import monotonic
 
+from jupyter_client.kernelspec import KernelSpecManager
 from traitlets import Bool, Dict, Float, Integer, List, Unicode, observe
 
-from .async_utils import await_then_kill, ensure_event_loop, wait_before
-from .client_helper import ExecClient, DeadKernelError
-from .limited import LimitedKernelManager, MaximumKernelsException
-from .py_snippets import (
-    python_update_cwd_code,
-    python_update_env_code,
-    python_init_import_code,
+from .async_utils import (
+    FairSemaphore,
+    await_then_kill,
+    ensure_async,
+    ensure_event_loop,
+)
+from .autoscale import DemandTracker, allocate_targets
+from .client_helper import (
+    ClientRegistry,
+    ExecClient,
+    ExecutionError,
+    DeadKernelError,
+    check_heartbeat,
 )
+from .init_files import InitFileCache
+from .kernel_pool import ADAPTABLE_KWARGS, KernelPool, PoolEntry, PoolVariant, kwargs_fingerprint
+from .limited import LimitedKernelManager, MaximumKernelsException
+from .notebook_pool import NotebookPool, notebook_stamp, read_prewarm_cells
+from .process_exit import exit_notification_supported, wait_for_exit
+from .py_snippets import InitStagesMixin, get_language_snippets
+from .spec_cache import KernelSpecCache
+from .zygote import Zygote, zygote_supported
 
+# The number of notebooks without prewarm cells to remember
+UNPOOLED_NOTEBOOKS_CACHE_SIZE = 1024
 
-class PooledKernelManager(LimitedKernelManager):
+
+class PooledKernelManager(InitStagesMixin, LimitedKernelManager):
     kernel_pools = Dict(
         Integer(0),
         config=True,
@@ -34,14 +57,25 @@ class PooledKernelManager(LimitedKernelManager):
         help="Mapping from kernel name to the arguments passed to kernel_start when pre-warming",
     )
 
+    pool_variants = Dict(
+        List(Dict()),
+        config=True,
+        help="Mapping from kernel name to a list of additional pools, each a dict with the 'kwargs' "
+        "passed to kernel_start when pre-warming, and the 'size' of the pool. Kernels are taken "
+        "from the pool with the same kwargs, or else from the one that needs the least "
+        "adaptation of path/cwd/env.",
+    )
+
     strict_pool_names = Bool(
         config=True,
-        help="Whether to allow starting kernels with other names than those explicitly listed in kernel_pools",
+        help="Whether to allow starting kernels with other names than those explicitly listed in kernel_pools "
+        "or pool_variants",
     )
 
     strict_pool_kwargs = Bool(
         config=True,
-        help="Whether to allow starting kernels with other kwargs than those explicitly listed in pool_kwargs",
+        help="Whether to allow starting kernels with other kwargs than those explicitly listed in pool_kwargs "
+        "or pool_variants",
     )
 
     fill_delay = Float(
@@ -50,96 +84,854 @@ class PooledKernelManager(LimitedKernelManager):
         help="Wait time before re-filling the pool after a kernel is used",
     )
 
+    max_concurrent_fills = Integer(
+        0,
+        config=True,
+        help="The maximum number of pooled kernels to start and initialize concurrently (0 for no limit). "
+        "Further kernels wait in a queue, where the pools take turns.",
+    )
+
     initialization_code = Dict(config=True, help="Code that gets executed at startup")
 
     python_imports = List(
         Unicode(), [], config=True, help="List of Python modules/packages to import"
     )
 
+    language_imports = Dict(
+        List(Unicode()),
+        config=True,
+        help="Mapping from kernelspec language to a list of modules/packages to import, "
+        "for languages with snippets in hotpot_km.py_snippets (e.g. R, julia)",
+    )
+
+    pool_zygote = List(
+        Unicode(),
+        [],
+        config=True,
+        help="Kernel names whose kernels are forked from a template process that has already "
+        "imported ipykernel and python_imports. This only applies to ipykernel kernels on "
+        "platforms with fork, and requires jupyter_client 7 or later. Environment variables "
+        "read at import time reflect the environment of the template process.",
+    )
+
+    pool_autoscale = Bool(
+        False,
+        config=True,
+        help="Whether to size the pools by the demand for kernels, instead of using kernel_pools directly",
+    )
+
+    pool_autoscale_min = Dict(
+        Integer(0),
+        config=True,
+        help="Mapping from kernel name to the minimum pool size when autoscaling (default 0)",
+    )
+
+    pool_autoscale_max = Dict(
+        Integer(0),
+        config=True,
+        help="Mapping from kernel name to the maximum pool size when autoscaling (default is the kernel_pools value)",
+    )
+
+    pool_autoscale_horizon = Float(
+        60,
+        config=True,
+        help="Number of seconds of forecast demand to keep on standby when autoscaling. "
+        "This should be at least the time it takes to start and initialize a kernel.",
+    )
+
+    pool_autoscale_halflife = Float(
+        300,
+        config=True,
+        help="Half-life in seconds of the moving average used to estimate the demand for kernels",
+    )
+
+    pool_autoscale_interval = Float(
+        10,
+        config=True,
+        help="Interval in seconds between re-evaluations of the autoscaled pool sizes",
+    )
+
+    pool_health_check_interval = Float(
+        0,
+        config=True,
+        help="Interval in seconds between liveness checks of the ready kernels in the pools (0 to disable). "
+        "Dead kernels are removed and replaced.",
+    )
+
+    pool_health_check_heartbeat = Bool(
+        False,
+        config=True,
+        help="Whether the liveness checks should also require a response on the heartbeat channel",
+    )
+
+    pool_health_check_timeout = Float(
+        5,
+        config=True,
+        help="Time in seconds to wait for a heartbeat response during liveness checks",
+    )
+
+    pool_watch_exits = Bool(
+        True,
+        config=True,
+        help="Whether to replace pooled kernels as soon as their process exits. This only applies "
+        "where process exits can be waited for without polling (Linux with Python 3.9 or later).",
+    )
+
+    pool_max_age = Float(
+        0,
+        config=True,
+        help="Time in seconds after which a pooled kernel is replaced, counted from when it was started (0 for no limit)",
+    )
+
+    pool_max_idle = Float(
+        0,
+        config=True,
+        help="Time in seconds after which a pooled kernel is replaced, counted from when it became ready (0 for no limit)",
+    )
+
+    pool_recycle_interval = Float(
+        60,
+        config=True,
+        help="Interval in seconds between checks for pooled kernels that should be replaced",
+    )
+
+    pool_reload_init_files = Bool(
+        False,
+        config=True,
+        help="Whether to replace pooled kernels when their kernel_pool_init files change. "
+        "The files are checked every pool_recycle_interval seconds.",
+    )
+
+    pool_recycle_concurrency = Integer(
+        1,
+        config=True,
+        help="The maximum number of kernels per kernel name that are replaced at the same time. "
+        "Replacements are ready before the kernel they replace is removed, so the pool does not shrink.",
+    )
+
+    max_notebook_pools = Integer(
+        0,
+        config=True,
+        help="The maximum number of notebooks to keep prewarmed kernels for (0 to disable). "
+        "When exceeded, the kernels of the least recently used notebook are shut down.",
+    )
+
+    notebook_pool_size = Integer(
+        1,
+        config=True,
+        help="The number of prewarmed kernels to keep on standby for each notebook",
+    )
+
+    notebook_prewarm_tag = Unicode(
+        "hotpot-prewarm",
+        config=True,
+        help="Cell tag of the code cells that prewarmed kernels run ahead of time",
+    )
+
+    notebook_path_kwarg = Unicode(
+        "notebook_path",
+        config=True,
+        help="Name of the start_kernel argument giving the file path of the notebook a kernel is for. "
+        "Kernels for notebooks with tagged cells are served from notebook pools, which are "
+        "invalidated when the notebook file changes.",
+    )
+
     _wait_at_startup = Bool(
         False, config=True, help="Wait till all kernels pools are filled at startup"
     )
 
     _pools = Dict()
 
+    # Mapping of kernel_id -> (kernel name, entry) for kernels owned by a pool
+    _pooled_kernels = Dict()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self._periodic_tasks = []
+        self._pool_metrics = defaultdict(Counter)
+        # Mapping of kernel name -> set of replacement entries being started
+        self._recycling = defaultdict(set)
+        self._demand = DemandTracker(self.pool_autoscale_halflife)
+        self._fill_limiter = FairSemaphore(self.max_concurrent_fills)
+        # Mapping of kernel name -> zygote that forks its kernels
+        self._zygotes = {}
+        self._init_files = InitFileCache()
+        # The connected clients of the pooled kernels, stopped on shutdown
+        self._clients = ClientRegistry()
+        # Mapping of kernel name -> digest of the current kernel_pool_init files
+        self._init_digests = {}
+        # Mapping of kernel name or (kernel name, notebook path) -> (stages, bundled code)
+        self._init_bundles = {}
+        # Mapping of notebook path -> NotebookPool, least recently used first
+        self._notebook_pools = OrderedDict()
+        # Mapping of notebook path -> notebook_stamp, for notebooks that are
+        # not pooled at that version, least recently added first
+        self._unpooled_notebooks = OrderedDict()
+        self._spec_cache = KernelSpecCache(
+            self.kernel_spec_manager or KernelSpecManager(parent=self)
+        )
+        self._discarded = []
+        # Mapping of (kernel name, kwargs fingerprint) -> PoolVariant
+        self._variants = {}
+        # Mapping of (kernel name, base fingerprint) -> PoolVariants that can be adapted
+        self._compatible_variants = defaultdict(list)
+        # Config digests that replacement kernels failed to start with
+        self._failed_config_digests = set()
+        self._update_variants()
         self.fill_if_needed(delay=0)
         if self._wait_at_startup:
             loop = ensure_event_loop()
             loop.run_until_complete(self.wait_for_pool())
         self.observe(self._pool_size_changed, "kernel_pools")
-        self._discarded = []
+        self.observe(self._pool_variants_updated, "pool_variants")
+        self.observe(self._max_concurrent_fills_updated, "max_concurrent_fills")
+        self.observe(
+            self._pool_config_updated,
+            ["pool_kwargs", "initialization_code", "python_imports", "language_imports"],
+        )
 
     def _pool_size_changed(self, change):
         self.unfill_as_needed()
         self.fill_if_needed()
 
+    def _pool_variants_updated(self, change):
+        self._update_variants()
+        self.unfill_as_needed()
+        self.fill_if_needed()
+
+    def _max_concurrent_fills_updated(self, change):
+        # Fills holding the old limiter release it when they complete
+        self._fill_limiter = FairSemaphore(self.max_concurrent_fills)
+
+    def _pool_config_updated(self, change):
+        self.log.info("Replacing pooled kernels after a change of %s", change["name"])
+        self._failed_config_digests.clear()
+        self._recycle_outdated()
+
+    def _config_digest(self, entry):
+        """A digest of the configuration a pooled kernel is started and initialized with"""
+        language = self._spec_cache.get_language(entry.kernel_name)
+        config = dict(
+            kwargs=self._pool_kwargs_of(entry),
+            initialization_code=self.initialization_code.get(entry.kernel_name),
+            imports=self._imports_stage(language),
+        )
+        return kwargs_fingerprint(config)
+
+    def _recycle_outdated(self):
+        """Replace the pooled kernels that were started with an outdated configuration"""
+        for pool in self._all_pools():
+            entries = list(pool)
+            if not entries:
+                continue
+            # All entries of a pool share their configuration
+            digest = self._config_digest(entries[0])
+            if digest in self._failed_config_digests:
+                # Don't retry until the configuration changes
+                continue
+            outdated = [entry for entry in entries if entry.config_digest != digest]
+            if outdated:
+                self._recycle(entries[0].kernel_name, outdated)
+
+    def _update_variants(self):
+        """Sync the pool variants with the pool_variants config, keeping unchanged pools"""
+        variants = {}
+        for name, configs in self.pool_variants.items():
+            for config in configs:
+                kwargs = config.get("kwargs", {})
+                key = (name, kwargs_fingerprint(kwargs))
+                variant = self._variants.pop(key, None) or PoolVariant(name, kwargs)
+                variant.size = config.get("size", 1)
+                variants[key] = variant
+        for variant in self._variants.values():
+            self._discard_pool(variant.pool)
+        self._variants = variants
+        self._compatible_variants = defaultdict(list)
+        for variant in variants.values():
+            key = (variant.kernel_name, variant.base_fingerprint)
+            self._compatible_variants[key].append(variant)
+
     def _should_use_pool(self, kernel_name, kwargs):
-        """Verify name and kwargs, and check whether we should use the pool"""
+        """Verify name and kwargs, and get the pool to take a kernel from, if any.
+
+        This is the pool variant with the same kwargs, or the kernel_pools pool
+        if its pool_kwargs are the same, or else the variant that is the
+        cheapest to adapt to kwargs, falling back to the kernel_pools pool.
+        """
         if "kernel_id" in kwargs:
-            return False
+            return None
 
-        if self.strict_pool_names and kernel_name not in self.kernel_pools:
+        fingerprint = kwargs_fingerprint(kwargs)
+        variant = self._variants.get((kernel_name, fingerprint))
+        if self.strict_pool_names and (
+            kernel_name not in self.kernel_pools and kernel_name not in self.pool_variants
+        ):
             raise ValueError("Cannot start kernel with name %r" % (kernel_name,))
-        if self.strict_pool_kwargs and (
+        if self.strict_pool_kwargs and variant is None and (
             kernel_name not in self.pool_kwargs or kwargs != self.pool_kwargs[kernel_name]
         ):
             raise ValueError("Cannot start kernel with kwargs %r" % (kwargs,))
 
-        return len(self._pools.get(kernel_name, ())) > 0
+        if variant is not None and len(variant.pool):
+            return variant.pool
+        pool = self._pools.get(kernel_name)
+        if pool and kwargs == self.pool_kwargs.get(kernel_name, {}):
+            return pool
+        compatible = self._compatible_variants.get(
+            (kernel_name, kwargs_fingerprint(kwargs, ADAPTABLE_KWARGS)), ()
+        )
+        if compatible and get_language_snippets(self._spec_cache.get_language(kernel_name)):
+            variant = min(
+                (v for v in compatible if len(v.pool)),
+                key=lambda v: (not v.pool.count_ready(), v.adaptation_cost(kwargs)),
+                default=None,
+            )
+            if variant is not None:
+                return variant.pool
+        return pool or None
+
+    def _pool_targets(self):
+        """The number of kernels to keep in each pool"""
+        if not self.pool_autoscale:
+            return self.kernel_pools
+        horizon = self.pool_autoscale_horizon
+        demand = {name: self._demand.rate(name) * horizon for name in self.kernel_pools}
+        bounds = {
+            name: (
+                self.pool_autoscale_min.get(name, 0),
+                self.pool_autoscale_max.get(name, target),
+            )
+            for name, target in self.kernel_pools.items()
+        }
+        capacity = None
+        if self.max_kernels > 0:
+            pooled = sum(len(pool) for pool in self._pools.values())
+            capacity = self.max_kernels - max(0, len(self) + self._reserved - pooled)
+        return allocate_targets(demand, bounds, capacity)
+
+    def _start_periodic_tasks(self):
+        if self._periodic_tasks:
+            return
+        if self.pool_autoscale:
+            self._start_periodic(self.pool_autoscale_interval, self._autoscale)
+        if self.pool_health_check_interval > 0:
+            self._start_periodic(self.pool_health_check_interval, self._check_pool_health)
+        if self.pool_max_age > 0 or self.pool_max_idle > 0 or self.pool_reload_init_files:
+            self._start_periodic(self.pool_recycle_interval, self._recycle_expired)
+
+    def _start_periodic(self, interval, callback):
+        loop = ensure_event_loop()
+        self._periodic_tasks.append(loop.create_task(self._run_periodic(interval, callback)))
+
+    async def _run_periodic(self, interval, callback):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await ensure_async(callback())
+            except Exception:
+                self.log.exception("Periodic pool maintenance failed")
+
+    def _autoscale(self):
+        self.unfill_as_needed()
+        self.fill_if_needed()
+
+    async def _check_pool_health(self):
+        """Remove and replace any ready pooled kernels that have died"""
+        entries = [entry for pool in self._all_pools() for entry in pool.ready()]
+        alive = await asyncio.gather(*(self._is_healthy(entry) for entry in entries))
+        evicted = False
+        for entry, ok in zip(entries, alive):
+            metrics = self._pool_metrics[entry.kernel_name]
+            metrics["health_checks"] += 1
+            pool = self._pool_of(entry)
+            if ok or pool is None or entry not in pool:
+                continue
+            self.log.warning("Replacing dead pooled kernel: %s", entry.kernel_id)
+            metrics["health_check_failures"] += 1
+            pool.remove(entry)
+            self._unindex(entry)
+            evicted = True
+            try:
+                await self.shutdown_kernel(entry.kernel_id, now=True)
+            except Exception:
+                self.log.exception("Failed to clean up dead kernel")
+        if evicted:
+            self.fill_if_needed(delay=0)
+
+    async def _is_healthy(self, entry):
+        if entry.restarted:
+            return False
+        kernel_id = entry.kernel_id
+        try:
+            kernel = self.get_kernel(kernel_id)
+            if not await ensure_async(kernel.is_alive()):
+                return False
+            if self.pool_health_check_heartbeat:
+                return await check_heartbeat(kernel, self.pool_health_check_timeout)
+        except Exception:
+            self.log.exception("Liveness check failed for kernel: %s", kernel_id)
+            return False
+        return True
+
+    def _recycle_expired(self):
+        """Replace pooled kernels that have exceeded pool_max_age or pool_max_idle,
+        or that were initialized with outdated kernel_pool_init files or configuration"""
+        now = monotonic()
+        # Mapping of kernel name -> digest of its current kernel_pool_init files
+        digests = {}
+        # Mapping of kernel name -> expired entries, of all pools of that kernel
+        expired = defaultdict(list)
+        for pool in self._all_pools():
+            for entry in pool.ready():
+                name = entry.kernel_name
+                if self.pool_reload_init_files and name not in digests:
+                    self._load_init_files(name, self._spec_cache.get_language(name))
+                    digests[name] = self._init_digests.get(name)
+                digest = digests.get(name)
+                if (
+                    (self.pool_max_age > 0 and now - entry.created > self.pool_max_age)
+                    or (self.pool_max_idle > 0 and now - entry.ready_at > self.pool_max_idle)
+                    or (digest is not None and entry.init_digest != digest)
+                ):
+                    expired[name].append(entry)
+        for name, entries in expired.items():
+            self._recycle(name, entries)
+        self._recycle_outdated()
+
+    def _recycle(self, name, entries):
+        """Gradually replace the given entries of a pool.
+
+        Each replacement is started outside of the pool, and swapped in for
+        the entry it replaces once it is ready. At most pool_recycle_concurrency
+        replacements are started per kernel name at a time, and entries that
+        are not replaced now should be passed again later.
+        """
+        recycling = self._recycling[name]
+        loop = ensure_event_loop()
+        # Don't start a replacement for an entry that is already being replaced
+        replacing = {entry.replaces for entry in recycling}
+        for old in entries:
+            if len(recycling) >= self.pool_recycle_concurrency:
+                break
+            if old in replacing:
+                continue
+            self.log.debug("Recycling pooled kernel: %s", old.kernel_id)
+            entry = PoolEntry(name)
+            entry.replaces = old
+            entry.variant = old.variant
+            entry.notebook = old.notebook
+            entry.task = loop.create_task(self._fill_kernel(entry, 0))
+            entry.task.add_done_callback(lambda task, entry=entry: self._swap_recycled(entry))
+            recycling.add(entry)
+
+    def _swap_recycled(self, entry):
+        recycling = self._recycling[entry.kernel_name]
+        if entry not in recycling:
+            # The replacement was cancelled, or the pools have been shut down
+            return
+        recycling.discard(entry)
+        task = entry.task
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            # Keep the old kernel
+            if isinstance(error, MaximumKernelsException):
+                return
+            self.log.warning(
+                "Failed to start a replacement pooled kernel", exc_info=(type(error), error, None)
+            )
+            if entry.config_digest != entry.replaces.config_digest:
+                self._failed_config_digests.add(entry.config_digest)
+            return
+        old = entry.replaces
+        entry.replaces = None
+        if self._pooled_kernels.get(entry.kernel_id, (None, None))[1] is not entry:
+            # The kernel has been shut down
+            return
+        pool = self._pool_of(entry)
+        if pool is None:
+            # The variant or notebook pool has been discarded
+            self._unindex(entry)
+            self._discarded.append(ensure_event_loop().create_task(await_then_kill(self, entry)))
+            return
+        pool.add(entry)
+        self._pool_metrics[entry.kernel_name]["recycled"] += 1
+        if old in pool:
+            pool.remove(old)
+            self._unindex(old)
+            self._discarded.append(ensure_event_loop().create_task(await_then_kill(self, old)))
+        else:
+            # The old kernel has been used in the meantime
+            self.unfill_as_needed()
+        # Continue any rollout of a configuration change
+        self._recycle_outdated()
+
+    def _record_adaptation(self, kernel_name, kernel_id, duration):
+        self.log.debug("Adapted pooled kernel %s in %.3f s", kernel_id, duration)
+        metrics = self._pool_metrics[kernel_name]
+        metrics["adaptations"] += 1
+        metrics["adaptation_time_total"] += duration
+        metrics["adaptation_time_max"] = max(metrics["adaptation_time_max"], duration)
+
+    def get_pool_metrics(self):
+        """Get the current size and the event counts of each pool"""
+        metrics = {}
+        for name in set(self._pools) | set(self._pool_metrics):
+            pool = self._pools.get(name, ())
+            metrics[name] = dict(
+                self._pool_metrics[name],
+                size=len(pool),
+                ready=len(pool.ready()) if pool else 0,
+            )
+        return metrics
 
     def unfill_as_needed(self):
         """Kills extra kernels in pool"""
         tasks = []
         loop = ensure_event_loop()
-        for name, target in self.kernel_pools.items():
-            pool = self._pools.get(name, [])
-            self._pools[name] = pool
+        targets = [
+            (self._pools.setdefault(name, KernelPool()), target)
+            for name, target in self._pool_targets().items()
+        ]
+        targets.extend((variant.pool, variant.size) for variant in self._variants.values())
+        for pool, target in targets:
             for i in range(len(pool) - target):
-                task = loop.create_task(await_then_kill(self, pool.pop(0)))
+                entry = pool.pop_last()
+                self._unindex(entry)
+                task = loop.create_task(await_then_kill(self, entry))
                 self._discarded.append(task)
 
     def fill_if_needed(self, delay=None):
         """Start kernels until pool is full"""
         delay = delay if delay is not None else self.fill_delay
         loop = ensure_event_loop()
-        for name, target in self.kernel_pools.items():
-            pool = self._pools.get(name, [])
-            self._pools[name] = pool
+        self._start_periodic_tasks()
+        for name, target in self._pool_targets().items():
+            pool = self._pools.setdefault(name, KernelPool())
             for i in range(target - len(pool)):
-                kw = self.pool_kwargs.get(name, {})
-                fut = super().start_kernel(kernel_name=name, **kw)
+                entry = PoolEntry(name)
                 # Start the work on the loop immediately, so it is ready when needed:
-                task = loop.create_task(wait_before(delay, self._initialize(name, fut)))
-                pool.append(task)
+                entry.task = loop.create_task(self._fill_kernel(entry, delay))
+                pool.add(entry)
+        for variant in self._variants.values():
+            for i in range(variant.size - len(variant.pool)):
+                entry = PoolEntry(variant.kernel_name)
+                entry.variant = variant
+                entry.task = loop.create_task(self._fill_kernel(entry, delay))
+                variant.pool.add(entry)
+
+    async def _fill_kernel(self, entry, delay):
+        """Start and initialize a kernel for the pool"""
+        name = entry.kernel_name
+        await asyncio.sleep(delay)
+        limiter = self._fill_limiter if self.max_concurrent_fills > 0 else None
+        if limiter is not None:
+            await limiter.acquire(name)
+        try:
+            kw = self._pool_kwargs_of(entry)
+            entry.config_digest = self._config_digest(entry)
+            # Pool fills should not hold up requests waiting for capacity:
+            self._try_reserve_capacity()
+            try:
+                entry.kernel_id = await super(LimitedKernelManager, self).start_kernel(
+                    kernel_name=name, **kw
+                )
+            finally:
+                self._release_capacity()
+            self._pooled_kernels[entry.kernel_id] = (name, entry)
+
+            def on_restart():
+                entry.restarted = True
+
+            kernel = self.get_kernel(entry.kernel_id)
+            kernel.add_restart_callback(on_restart)
+            # Keep a connected client until the kernel is handed out:
+            client = ExecClient(kernel, registry=self._clients)
+            try:
+                await client.start_new_kernel_client()
+            except BaseException:
+                await client.cleanup_client()
+                raise
+            if self._pooled_kernels.get(entry.kernel_id, (None, None))[1] is entry:
+                entry.client = client
+            else:
+                # The kernel was discarded while we connected
+                await client.cleanup_client()
+            kernel_id = await self._initialize(
+                name, entry.kernel_id, entry.client, entry.notebook
+            )
+            entry.init_digest = self._init_digests.get(name)
+            entry.ready_at = monotonic()
+            watch = self.pool_watch_exits and exit_notification_supported()
+            if watch and entry.kernel_id in self._pooled_kernels:
+                entry.watcher = ensure_event_loop().create_task(
+                    self._watch_pooled_kernel(entry, kernel)
+                )
+            return kernel_id
+        except Exception:
+            self._unindex(entry)
+            # Don't leave a kernel running that failed to initialize
+            await self._shutdown_failed(entry)
+            raise
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+    async def _watch_pooled_kernel(self, entry, kernel):
+        """Remove and replace a pooled kernel as soon as its process exits"""
+        await wait_for_exit(kernel)
+        entry.watcher = None
+        pool = self._pool_of(entry)
+        if pool is None or entry not in pool:
+            return
+        self.log.warning("Replacing dead pooled kernel: %s", entry.kernel_id)
+        self._pool_metrics[entry.kernel_name]["died"] += 1
+        pool.remove(entry)
+        self._unindex(entry)
+        try:
+            await self.shutdown_kernel(entry.kernel_id, now=True)
+        except Exception:
+            self.log.exception("Failed to clean up dead kernel")
+        self.fill_if_needed(delay=0)
+
+    def _unindex(self, entry):
+        """Remove an entry from the kernel index, and stop tracking its kernel"""
+        entry.stop_watching()
+        entry.close_client()
+        if entry.kernel_id is not None:
+            if self._pooled_kernels.get(entry.kernel_id, (None, None))[1] is entry:
+                del self._pooled_kernels[entry.kernel_id]
+
+    async def _shutdown_failed(self, entry):
+        """Shut down the kernel of an entry that failed, if it was started"""
+        if entry.kernel_id is None or entry.kernel_id not in self:
+            return
+        try:
+            await self.shutdown_kernel(entry.kernel_id, now=True)
+        except Exception:
+            self.log.exception("Failed to clean up kernel: %s", entry.kernel_id)
+
+    async def _reserve_capacity(self):
+        # Make room for the requested kernel by shutting down idle pooled kernels
+        while not self._admission_queue and self._at_capacity():
+            pool = max(self._all_pools(), key=KernelPool.count_ready, default=None)
+            if pool is None or not pool.count_ready():
+                break
+            entry = pool.ready()[-1]
+            pool.remove(entry)
+            self._unindex(entry)
+            self._pool_metrics[entry.kernel_name]["evicted"] += 1
+            await self.shutdown_kernel(entry.kernel_id, now=True)
+        await super()._reserve_capacity()
 
     async def wait_for_pool(self):
         all_tasks = []
-        for pool in self._pools.values():
-            all_tasks.extend(pool)
+        for pool in self._all_pools():
+            all_tasks.extend(entry.task for entry in pool)
         await asyncio.gather(*all_tasks)
 
-    async def _pop_pooled_kernel(self, kernel_name, kwargs):
-        fut = self._pools[kernel_name].pop(0)
-        return await self._update_kernel(kernel_name, fut, kwargs)
+    def _all_pools(self):
+        """The kernel pools, and those of the pool variants and notebook pools"""
+        return chain(
+            self._pools.values(),
+            (variant.pool for variant in self._variants.values()),
+            (nb.pool for nb in self._notebook_pools.values()),
+        )
+
+    def _pool_of(self, entry):
+        """The pool an entry belongs in, if it still exists"""
+        if entry.notebook is not None:
+            notebook = self._notebook_pools.get(entry.notebook.path)
+            return notebook.pool if notebook is entry.notebook else None
+        if entry.variant is not None:
+            variant = self._variants.get((entry.kernel_name, entry.variant.fingerprint))
+            return variant.pool if variant is entry.variant else None
+        return self._pools.get(entry.kernel_name)
+
+    def _pool_kwargs_of(self, entry):
+        """The kwargs the kernel of an entry is started with"""
+        if entry.variant is not None:
+            return entry.variant.kwargs
+        kwargs = self.pool_kwargs.get(entry.kernel_name, {})
+        if entry.notebook is not None:
+            # Prewarm cells can read files relative to the notebook
+            kwargs = dict(kwargs, cwd=os.path.dirname(entry.notebook.path))
+            kwargs.pop("path", None)
+        return kwargs
+
+    async def _notebook_pool(self, kernel_name, path):
+        """Get the up to date notebook pool of a notebook, if it has prewarm cells"""
+        path = os.path.abspath(path)
+        stamp = notebook_stamp(path)
+        notebook = self._notebook_pools.get(path)
+        if notebook is not None and (
+            notebook.stamp != stamp or notebook.kernel_name != kernel_name
+        ):
+            self.log.info("Invalidating the pooled kernels of notebook %s", path)
+            self._discard_notebook_pool(notebook)
+            notebook = None
+        if stamp is None:
+            return None
+        if notebook is None:
+            if self._unpooled_notebooks.get(path) == stamp:
+                return None
+            try:
+                # Reading validates the notebook, which is too slow for the event loop
+                cells = await asyncio.get_event_loop().run_in_executor(
+                    None, read_prewarm_cells, path, self.notebook_prewarm_tag
+                )
+            except Exception:
+                self.log.warning("Failed to read prewarm cells of %s", path, exc_info=True)
+                cells = []
+            if not cells:
+                self._skip_notebook(path, stamp)
+                return None
+            self._unpooled_notebooks.pop(path, None)
+            # Another request might have read the notebook in the meantime
+            notebook = self._notebook_pools.get(path)
+            if notebook is None or notebook.stamp != stamp or notebook.kernel_name != kernel_name:
+                if notebook is not None:
+                    self._discard_notebook_pool(notebook)
+                notebook = NotebookPool(path, kernel_name, stamp, cells)
+                self._notebook_pools[path] = notebook
+                while len(self._notebook_pools) > self.max_notebook_pools:
+                    _, evicted = self._notebook_pools.popitem(last=False)
+                    self.log.debug("Evicting the pooled kernels of notebook %s", evicted.path)
+                    self._discard_notebook_pool(evicted)
+        self._notebook_pools.move_to_end(path)
+        return notebook
+
+    def _skip_notebook(self, path, stamp):
+        """Don't pool kernels for a notebook until it changes"""
+        self._unpooled_notebooks.pop(path, None)
+        self._unpooled_notebooks[path] = stamp
+        while len(self._unpooled_notebooks) > UNPOOLED_NOTEBOOKS_CACHE_SIZE:
+            self._unpooled_notebooks.popitem(last=False)
+
+    def _discard_notebook_pool(self, notebook):
+        if self._notebook_pools.get(notebook.path) is notebook:
+            del self._notebook_pools[notebook.path]
+        self._init_bundles.pop((notebook.kernel_name, notebook.path), None)
+        self._discard_pool(notebook.pool)
+
+    def _discard_pool(self, pool):
+        """Remove all entries of a pool, and shut down their kernels.
+
+        This includes any replacements being started for the pool.
+        """
+        loop = ensure_event_loop()
+        entries = list(pool)
+        for recycling in self._recycling.values():
+            replacing = [
+                entry
+                for entry in recycling
+                if (entry.variant is not None and entry.variant.pool is pool)
+                or (entry.notebook is not None and entry.notebook.pool is pool)
+            ]
+            recycling.difference_update(replacing)
+            entries.extend(replacing)
+        for entry in entries:
+            pool.remove(entry)
+            self._unindex(entry)
+            self._discarded.append(loop.create_task(await_then_kill(self, entry)))
+
+    def _fill_notebook_pool(self, notebook, delay):
+        """Start kernels until the pool of a notebook is full"""
+        if self._notebook_pools.get(notebook.path) is not notebook:
+            return
+        loop = ensure_event_loop()
+        for i in range(self.notebook_pool_size - len(notebook.pool)):
+            entry = PoolEntry(notebook.kernel_name)
+            entry.notebook = notebook
+            entry.task = loop.create_task(self._fill_kernel(entry, delay))
+            notebook.pool.add(entry)
+
+    async def _pop_pooled_kernel(self, kernel_name, kwargs, pool=None):
+        if pool is None:
+            pool = self._pools[kernel_name]
+        entry = pool.pop()
+        try:
+            await entry
+            return await self._update_kernel(
+                kernel_name, entry, kwargs, entry.client, self._pool_kwargs_of(entry)
+            )
+        except Exception:
+            # Don't leave a kernel running that could not be handed out
+            self._unindex(entry)
+            await self._shutdown_failed(entry)
+            raise
+        finally:
+            self._unindex(entry)
 
     async def start_kernel(self, kernel_name=None, **kwargs):
         if kernel_name is None:
             kernel_name = self.default_kernel_name
+        if kwargs.get("kernel_id") in self:
+            kwargs.pop(self.notebook_path_kwarg, None)
         self.log.debug("Starting kernel: %s", kernel_name)
-        kernel_id = kwargs.get("kernel_id")
-        while kernel_id is None and self._should_use_pool(kernel_name, kwargs):
-            try:
-                kernel_id = await self._pop_pooled_kernel(kernel_name, kwargs)
-            except (MaximumKernelsException, DeadKernelError):
-                pass
-        if kernel_id is None or kwargs.get("kernel_id") is not None:
-            kernel_id = await super().start_kernel(kernel_name=kernel_name, **kwargs)
+        if kwargs.get("kernel_id") is None and kernel_name in self.kernel_pools:
+            self._demand.record(kernel_name)
+        kernel_id = await super().start_kernel(kernel_name=kernel_name, **kwargs)
 
         self.fill_if_needed()
         return kernel_id
 
+    def pre_start_kernel(self, kernel_name, kwargs):
+        km, kernel_name, kernel_id = super().pre_start_kernel(kernel_name, kwargs)
+        if kernel_name in self.pool_zygote and zygote_supported():
+            from .zygote import ZygoteProvisioner
+
+            if kernel_name not in self._zygotes:
+                self._zygotes[kernel_name] = Zygote(self.python_imports, self.log)
+            km.provisioner = ZygoteProvisioner(
+                kernel_id=kernel_id, kernel_spec=km.kernel_spec, parent=km
+            )
+            km.provisioner.zygote = self._zygotes[kernel_name]
+        return km, kernel_name, kernel_id
+
+    async def _start_claimed_kernel(self, kernel_name, kwargs):
+        path = kwargs.pop(self.notebook_path_kwarg, None)
+        notebook = None
+        if path is not None and self.max_notebook_pools > 0 and "kernel_id" not in kwargs:
+            notebook = await self._notebook_pool(kernel_name, path)
+        if notebook is not None:
+            # Check the name and kwargs, even if we don't use the kernel pool
+            self._should_use_pool(kernel_name, kwargs)
+            delay = self.fill_delay if len(notebook.pool) else 0
+            try:
+                while len(notebook.pool):
+                    try:
+                        return await self._pop_pooled_kernel(kernel_name, kwargs, notebook.pool)
+                    except (MaximumKernelsException, DeadKernelError):
+                        pass
+                    except Exception:
+                        # E.g. a failing prewarm cell, which should not fail the request.
+                        # The other kernels of the pool would fail the same way.
+                        self.log.warning(
+                            "Failed to prewarm kernel for %s, not pooling it until it changes",
+                            path,
+                            exc_info=True,
+                        )
+                        self._discard_notebook_pool(notebook)
+                        self._skip_notebook(notebook.path, notebook.stamp)
+                        break
+            finally:
+                self._fill_notebook_pool(notebook, delay)
+        # Pooled kernels only count towards the quotas once they are handed out here
+        while True:
+            pool = self._should_use_pool(kernel_name, kwargs)
+            if pool is None:
+                break
+            try:
+                return await self._pop_pooled_kernel(kernel_name, kwargs, pool)
+            except (MaximumKernelsException, DeadKernelError):
+                pass
+        if kwargs.get("env"):
+            # Variables to unset in pooled kernels are simply left out of new ones
+            kwargs["env"] = {k: v for k, v in kwargs["env"].items() if v is not None}
+        return await super()._start_claimed_kernel(kernel_name, kwargs)
+
     async def restart_kernel(self, kernel_id, **kwargs):
         km = self.get_kernel(kernel_id)
         kernel_name = km.kernel_name
@@ -147,32 +939,45 @@ class PooledKernelManager(LimitedKernelManager):
         id_future = asyncio.Future()
         id_future.set_result(kernel_id)
         await self._update_kernel(kernel_name, id_future, km._launch_args)
-        await self._initialize(kernel_name, id_future)
+        await self._initialize(kernel_name, kernel_id)
 
     async def shutdown_kernel(self, kernel_id, *args, **kwargs):
-        for pool in self._pools.values():
-            for i, f in enumerate(pool):
-                try:
-                    if f.done() and f.result() == kernel_id:
-                        pool.pop(i)
-                        break
-                except Exception as e:
-                    if not isinstance(e, MaximumKernelsException):
-                        self.log.exception("Kernel failed starting up")
-                    pool.pop(i)
-            else:
-                continue
-            break
+        name, entry = self._pooled_kernels.pop(kernel_id, (None, None))
+        if entry is not None:
+            entry.stop_watching()
+            entry.close_client()
+            pool = self._pool_of(entry)
+            if pool is not None:
+                pool.remove(entry)
+            if not entry.task.done():
+                entry.task.cancel()
         return await super().shutdown_kernel(kernel_id, *args, **kwargs)
 
     async def shutdown_all(self, *args, **kwargs):
+        for task in self._periodic_tasks:
+            task.cancel()
+        self._periodic_tasks = []
+        for pool in self._all_pools():
+            for entry in pool:
+                entry.stop_watching()
         await super().shutdown_all(*args, **kwargs)
         # Parent doesn't correctly add all created kernels until they have completed startup:
         pools = self._pools
         self._pools = {}
-        for pool in pools.values():
+        notebooks = self._notebook_pools
+        self._notebook_pools = OrderedDict()
+        variant_pools = []
+        for variant in self._variants.values():
+            variant_pools.append(variant.pool)
+            variant.pool = KernelPool()
+        self._pooled_kernels = {}
+        recycling = self._recycling
+        self._recycling = defaultdict(set)
+        notebook_pools = (nb.pool for nb in notebooks.values())
+        for pool in chain(pools.values(), recycling.values(), variant_pools, notebook_pools):
             # The iteration gets confused if we don't copy pool
             for fut in tuple(pool):
+                fut.close_client()
                 try:
                     kid = await fut
                 except Exception as e:
@@ -187,9 +992,28 @@ class PooledKernelManager(LimitedKernelManager):
             if not isinstance(e, MaximumKernelsException):
                 self.log.exception("Kernel failed starting up")
         self._discarded = []
+        zygotes = self._zygotes
+        self._zygotes = {}
+        for zygote in zygotes.values():
+            await zygote.stop()
+        # Stop any clients still connected, e.g. of initializations in progress
+        self._clients.close_all()
+
+    @asynccontextmanager
+    async def _kernel_client(self, kernel_id, client=None):
+        """Use a connected client if given, or connect a new one"""
+        if client is not None and client.kc is not None:
+            yield client
+            return
+        client = ExecClient(self.get_kernel(kernel_id), registry=self._clients)
+        async with client.setup_kernel():
+            yield client
 
-    async def _update_kernel(self, kernel_name, kernel_id_future, kwargs):
-        base_kws = self.pool_kwargs.get(kernel_name)
+    async def _update_kernel(
+        self, kernel_name, kernel_id_future, kwargs, client=None, base_kws=None
+    ):
+        if base_kws is None:
+            base_kws = self.pool_kwargs.get(kernel_name)
         if base_kws:
             new_kws = {}
             for k, v in kwargs.items():
@@ -201,75 +1025,91 @@ class PooledKernelManager(LimitedKernelManager):
             new_kws = kwargs
 
         # Make sure that the kernel is in a state that matches kwargs
-        # Currently supported is a python kernel, and the path/cwd and env arguments
-        if kernel_name in ("python3", "python") and new_kws:
+        # Currently supported are the path/cwd and env arguments, for the
+        # languages in py_snippets
+        language = self._spec_cache.get_language(kernel_name)
+        snippets = get_language_snippets(language)
+        if new_kws and snippets is not None:
+            if "path" in new_kws:
+                new_kws["cwd"] = self.cwd_for_path(new_kws.pop("path"))
+            cwd = new_kws.pop("cwd", None)
+            env = new_kws.pop("env", None)
             # Avoid client overhead if not needed:
-            if "path" in new_kws or "cwd" in new_kws or "env" in new_kws:
-                kernel_id = await kernel_id_future
-                kernel = self.get_kernel(kernel_id)
-                client = ExecClient(kernel)
-                async with client.setup_kernel():
-                    if "path" in new_kws:
-                        new_kws["cwd"] = self.cwd_for_path(new_kws.pop("path"))
-                    if "cwd" in new_kws:
-                        cwd = new_kws.pop("cwd")
-                        code = python_update_cwd_code.format(cwd=cwd)
-                        self.log.debug("Updating preheated kernel CWD using")
-                        await client.execute(code)
-                    if "env" in new_kws:
-                        env = new_kws.pop("env")
-                        code = python_update_env_code.format(env=env)
-                        self.log.debug("Updating preheated kernel env vars")
+            if cwd is not None or env:
+                code = snippets.update_code(cwd, env or {})
+                if code is None:
+                    self.log.warning("Cannot adapt cwd/env of %s kernels", language)
+                else:
+                    start = monotonic()
+                    kernel_id = await kernel_id_future
+                    async with self._kernel_client(kernel_id, client) as client:
                         await client.execute(code)
+                    self._record_adaptation(kernel_name, kernel_id, monotonic() - start)
         if new_kws:
             self.log.debug("Unknown kwargs: %s", list(new_kws.keys()))
 
         return await kernel_id_future
 
-    async def _initialize(self, kernel_name, kernel_id_future):
-        """Run any configured initialization code in the kernel"""
-        kernel_id = await kernel_id_future
-        extension = None
-        language = None
+    def _load_init_files(self, kernel_name, language):
+        """Get the kernel_pool_init files of a kernel, noting whether they have changed"""
+        snippets = get_language_snippets(language)
+        extension = snippets and snippets.extension
+        if extension is None:
+            return []
+        scripts, digest = self._init_files.get(kernel_name, extension)
+        previous = self._init_digests.get(kernel_name, digest)
+        self._init_digests[kernel_name] = digest
+        if previous != digest:
+            self.log.info("The kernel_pool_init files for %s have changed", kernel_name)
+            self._pool_metrics[kernel_name]["init_files_changed"] += 1
+        return scripts
 
-        kernel = self.get_kernel(kernel_id)
+    async def _initialize(self, kernel_name, kernel_id, client=None, notebook=None):
+        """Run any configured initialization code in the kernel, and the prewarm
+        cells of a NotebookPool if given"""
+        language = None
 
         try:
-            language_to_extensions = {"python": "py"}
-            language = kernel.kernel_spec_manager.get_all_specs()[kernel_name]["spec"]["language"]
-            extension = language_to_extensions[language]
+            language = self._spec_cache.get_language(kernel_name)
         except Exception:
             pass
 
-        py_imports = language == "python" and self.python_imports
+        init_scripts = self._load_init_files(kernel_name, language)
+
+        imports_stage = self._imports_stage(language)
 
         config_code = self.initialization_code.get(kernel_name)
 
-        if not extension and not py_imports and not config_code:
+        stages = []
+        if imports_stage:
+            stages.append(imports_stage)
+        if config_code:
+            stages.append(("initialization_code", config_code))
+        stages.extend((str(path), code) for path, code in init_scripts)
+        if notebook is not None:
+            stages.extend(notebook.initialization_stages())
+
+        if not stages:
             # Save some effort
             return kernel_id
 
         self.log.info("Initializing kernel: %s", kernel_id)
 
-        client = ExecClient(kernel)
-
-        from jupyter_core.paths import jupyter_config_path
-        from pathlib import Path
-
-        async with client.setup_kernel():
-            if py_imports:
-                code = python_init_import_code.format(modules=self.python_imports)
-                await client.execute(code)
-            if config_code:
-                await client.execute(config_code)
-            if extension:
-                for base_path in map(Path, jupyter_config_path()):
-                    path = base_path / f"kernel_pool_init_{kernel_name}.{extension}"
-                    if path.exists():
-                        with open(path) as f:
-                            self.log.debug("Running %s for initializing kernel", path)
-                            code = f.read()
-                        await client.execute(code)
+        async with self._kernel_client(kernel_id, client) as client:
+            if language == "python":
+                # Submit all stages at once, to save round trips
+                try:
+                    key = kernel_name if notebook is None else (kernel_name, notebook.path)
+                    await client.execute(self._init_bundle(key, stages))
+                except ExecutionError as e:
+                    if e.ename == "InitializationError":
+                        stage = e.evalue.split(": ", 1)[0]
+                        self.log.error("Failed to initialize kernel %s in %s", kernel_id, stage)
+                    raise
+            else:
+                # Submit the stages back-to-back, to save round trips
+                self.log.debug("Running %s for initializing kernel", [n for n, _ in stages])
+                await client.execute_many([code for _, code in stages])
         self.log.debug("Initialized kernel: %s", kernel_id)
         return kernel_id
 
@@ -8,18 +8,18 @@ This module contains
 """
 
 import asyncio
+from time import monotonic
 
+from jupyter_client.kernelspec import KernelSpecManager
 from jupyter_client.multikernelmanager import MultiKernelManager
 from traitlets import Bool, Dict, Float, Integer, List, Unicode, observe
 
 from .async_utils import ensure_event_loop, just_run
-from .client_helper import ExecClient, DeadKernelError
+from .client_helper import ClientRegistry, ExecClient, ExecutionError, DeadKernelError
+from .init_files import InitFileCache
 from .limited import SyncLimitedKernelManager, MaximumKernelsException
-from .py_snippets import (
-    python_update_cwd_code,
-    python_update_env_code,
-    python_init_import_code,
-)
+from .py_snippets import InitStagesMixin, get_language_snippets
+from .spec_cache import KernelSpecCache
 
 
 async def _wait_before(delay, aw):
@@ -36,7 +36,7 @@ def _ensure_event_loop():
     return loop
 
 
-class SyncPooledKernelManager(SyncLimitedKernelManager):
+class SyncPooledKernelManager(InitStagesMixin, SyncLimitedKernelManager):
     kernel_pools = Dict(
         Integer(0),
         config=True,
@@ -71,11 +71,29 @@ class SyncPooledKernelManager(SyncLimitedKernelManager):
         Unicode(), [], config=True, help="List of Python modules/packages to import"
     )
 
+    language_imports = Dict(
+        List(Unicode()),
+        config=True,
+        help="Mapping from kernelspec language to a list of modules/packages to import, "
+        "for languages with snippets in hotpot_km.py_snippets (e.g. R, julia)",
+    )
+
     _pools = Dict()
     _init_futs = Dict()
 
+    # Mapping of kernel_id -> kernel name for kernels owned by a pool
+    _pooled_kernels = Dict()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self._init_files = InitFileCache()
+        # The connected clients of the pooled kernels, stopped on shutdown
+        self._clients = ClientRegistry()
+        # Mapping of kernel name -> (initialization stages, bundled code)
+        self._init_bundles = {}
+        self._spec_cache = KernelSpecCache(
+            self.kernel_spec_manager or KernelSpecManager(parent=self)
+        )
         self.fill_if_needed(delay=0)
         self.observe(self._pool_size_changed, "kernel_pools")
         self._discarded = []
@@ -106,6 +124,7 @@ class SyncPooledKernelManager(SyncLimitedKernelManager):
             self._pools[name] = pool
             for i in range(len(pool) - target):
                 kernel_id = pool.pop(0)
+                self._pooled_kernels.pop(kernel_id, None)
                 self.shutdown_kernel(kernel_id)
 
     def fill_if_needed(self, delay=None):
@@ -116,10 +135,18 @@ class SyncPooledKernelManager(SyncLimitedKernelManager):
             self._pools[name] = pool
             for i in range(target - len(pool)):
                 kw = self.pool_kwargs.get(name, {})
-                kernel_id = just_run(super().start_kernel(kernel_name=name, **kw))
+                # Pool fills should not hold up requests waiting for capacity:
+                self._try_reserve_capacity()
+                try:
+                    kernel_id = just_run(
+                        super(SyncLimitedKernelManager, self).start_kernel(kernel_name=name, **kw)
+                    )
+                finally:
+                    self._release_capacity()
                 # Todo: use delay
                 # Start the work on the loop immediately, so it is ready when needed:
                 self._init_futs[kernel_id] = loop.create_task(self._initialize(name, kernel_id))
+                self._pooled_kernels[kernel_id] = name
                 pool.append(kernel_id)
 
     async def wait_for_pool(self):
@@ -128,6 +155,7 @@ class SyncPooledKernelManager(SyncLimitedKernelManager):
     async def _pop_pooled_kernel(self, kernel_name, kwargs):
         self.log.debug("Using kernel from pool: %s", kernel_name)
         kernel_id = self._pools[kernel_name].pop(0)
+        self._pooled_kernels.pop(kernel_id, None)
         await self._init_futs.pop(kernel_id)
         return await self._update_kernel(kernel_name, kernel_id, kwargs)
 
@@ -135,14 +163,7 @@ class SyncPooledKernelManager(SyncLimitedKernelManager):
         if kernel_name is None:
             kernel_name = self.default_kernel_name
         self.log.debug("Starting kernel: %s", kernel_name)
-        kernel_id = kwargs.get("kernel_id")
-        while kernel_id is None and self._should_use_pool(kernel_name, kwargs):
-            try:
-                kernel_id = just_run(self._pop_pooled_kernel(kernel_name, kwargs))
-            except DeadKernelError:
-                pass
-        if kernel_id is None or kwargs.get("kernel_id") is not None:
-            kernel_id = just_run(super().start_kernel(kernel_name=kernel_name, **kwargs))
+        kernel_id = just_run(super().start_kernel(kernel_name=kernel_name, **kwargs))
 
         try:
             self.fill_if_needed()
@@ -150,6 +171,18 @@ class SyncPooledKernelManager(SyncLimitedKernelManager):
             pass
         return kernel_id
 
+    def _start_claimed_kernel(self, kernel_name, kwargs):
+        # Pooled kernels only count towards the quotas once they are handed out here
+        while self._should_use_pool(kernel_name, kwargs):
+            try:
+                return just_run(self._pop_pooled_kernel(kernel_name, kwargs))
+            except DeadKernelError:
+                pass
+        if kwargs.get("env"):
+            # Variables to unset in pooled kernels are simply left out of new ones
+            kwargs["env"] = {k: v for k, v in kwargs["env"].items() if v is not None}
+        return super()._start_claimed_kernel(kernel_name, kwargs)
+
     def restart_kernel(self, kernel_id, **kwargs):
         km = self.get_kernel(kernel_id)
         kernel_name = km.kernel_name
@@ -160,15 +193,15 @@ class SyncPooledKernelManager(SyncLimitedKernelManager):
     def shutdown_kernel(self, kernel_id, *args, **kwargs):
         if kernel_id in self._init_futs:
             self._init_futs.pop(kernel_id).cancel()
-        for pool in self._pools.values():
-            if kernel_id in pool:
-                pool.remove(kernel_id)
-                break
+        name = self._pooled_kernels.pop(kernel_id, None)
+        if name is not None:
+            self._pools[name].remove(kernel_id)
         return super().shutdown_kernel(kernel_id, *args, **kwargs)
 
     def shutdown_all(self, *args, **kwargs):
         pools = self._pools
         self._pools = {}
+        self._pooled_kernels = {}
         for pool in pools.values():
             # The iteration gets confused if we don't copy pool
             for kernel_id in tuple(pool):
@@ -176,6 +209,8 @@ class SyncPooledKernelManager(SyncLimitedKernelManager):
         for kernel_id in self.list_kernel_ids():
             self.shutdown_kernel(kernel_id, *args, **kwargs)
         self._init_futs = {}
+        # Stop any clients still connected, e.g. of initializations in progress
+        self._clients.close_all()
 
     async def _update_kernel(self, kernel_name, kernel_id, kwargs):
         base_kws = self.pool_kwargs.get(kernel_name)
@@ -190,25 +225,28 @@ class SyncPooledKernelManager(SyncLimitedKernelManager):
             new_kws = kwargs
 
         # Make sure that the kernel is in a state that matches kwargs
-        # Currently supported is a python kernel, and the path/cwd and env arguments
-        if kernel_name in ("python3", "python") and new_kws:
+        # Currently supported are the path/cwd and env arguments, for the
+        # languages in py_snippets
+        language = self._spec_cache.get_language(kernel_name)
+        snippets = get_language_snippets(language)
+        if new_kws and snippets is not None:
+            if "path" in new_kws:
+                new_kws["cwd"] = self.cwd_for_path(new_kws.pop("path"))
+            cwd = new_kws.pop("cwd", None)
+            env = new_kws.pop("env", None)
             # Avoid client overhead if not needed:
-            if "path" in new_kws or "cwd" in new_kws or "env" in new_kws:
-                kernel = self.get_kernel(kernel_id)
-                client = ExecClient(kernel)
-                async with client.setup_kernel():
-                    if "path" in new_kws:
-                        new_kws["cwd"] = self.cwd_for_path(new_kws.pop("path"))
-                    if "cwd" in new_kws:
-                        cwd = new_kws.pop("cwd")
-                        code = python_update_cwd_code.format(cwd=cwd)
-                        self.log.debug("Updating preheated kernel CWD using")
-                        await client.execute(code)
-                    if "env" in new_kws:
-                        env = new_kws.pop("env")
-                        code = python_update_env_code.format(env=env)
-                        self.log.debug("Updating preheated kernel env vars")
+            if cwd is not None or env:
+                code = snippets.update_code(cwd, env or {})
+                if code is None:
+                    self.log.warning("Cannot adapt cwd/env of %s kernels", language)
+                else:
+                    start = monotonic()
+                    client = ExecClient(self.get_kernel(kernel_id), registry=self._clients)
+                    async with client.setup_kernel():
                         await client.execute(code)
+                    self.log.debug(
+                        "Adapted pooled kernel %s in %.3f s", kernel_id, monotonic() - start
+                    )
         if new_kws:
             self.log.debug("Unknown kwargs: %s", list(new_kws.keys()))
 
@@ -216,43 +254,47 @@ class SyncPooledKernelManager(SyncLimitedKernelManager):
 
     async def _initialize(self, kernel_name, kernel_id):
         """Run any configured initialization code in the kernel"""
-        extension = None
         language = None
 
         kernel = self.get_kernel(kernel_id)
 
         try:
-            language_to_extensions = {"python": "py"}
-            language = kernel.kernel_spec_manager.get_all_specs()[kernel_name]["spec"]["language"]
-            extension = language_to_extensions[language]
+            language = self._spec_cache.get_language(kernel_name)
         except Exception:
             pass
 
-        py_imports = language == "python" and self.python_imports
+        snippets = get_language_snippets(language)
+        init_scripts = []
+        if snippets is not None and snippets.extension:
+            init_scripts, _ = self._init_files.get(kernel_name, snippets.extension)
 
-        if not extension and not py_imports:
+        stages = [(str(path), code) for path, code in init_scripts]
+        imports_stage = self._imports_stage(language)
+        if imports_stage:
+            stages.append(imports_stage)
+
+        if not stages:
             # Save some effort
             return kernel_id
 
         self.log.info("Initializing kernel: %s", kernel_id)
 
-        client = ExecClient(kernel)
-
-        from jupyter_core.paths import jupyter_config_path
-        from pathlib import Path
+        client = ExecClient(kernel, registry=self._clients)
 
         async with client.setup_kernel():
-            if extension:
-                for base_path in map(Path, jupyter_config_path()):
-                    path = base_path / f"kernel_pool_init_{kernel_name}.{extension}"
-                    if path.exists():
-                        with open(path) as f:
-                            self.log.debug("Running %s for initializing kernel", path)
-                            code = f.read()
-                        await client.execute(code)
-            if py_imports:
-                code = python_init_import_code.format(modules=self.python_imports)
-                await client.execute(code)
+            if language == "python":
+                # Submit all stages at once, to save round trips
+                try:
+                    await client.execute(self._init_bundle(kernel_name, stages))
+                except ExecutionError as e:
+                    if e.ename == "InitializationError":
+                        stage = e.evalue.split(": ", 1)[0]
+                        self.log.error("Failed to initialize kernel %s in %s", kernel_id, stage)
+                    raise
+            else:
+                # Submit the stages back-to-back, to save round trips
+                self.log.debug("Running %s for initializing kernel", [n for n, _ in stages])
+                await client.execute_many([code for _, code in stages])
         self.log.info("Initialized kernel: %s", kernel_id)
         return kernel_id
 
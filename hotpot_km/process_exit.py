@@ -0,0 +1,55 @@
+# coding: utf-8
+
+# Copyright (c) Vidar Tonaas Fauske.
+# Distributed under the terms of the Modified BSD License.
+"""Hotpot - Jupyter kernel manager helpers
+
+This module contains helpers for noticing when a kernel process exits.
+"""
+
+import asyncio
+import os
+
+from .async_utils import ensure_async
+from .memory import kernel_pid
+
+
+def exit_notification_supported():
+    """Whether process exits can be waited for without polling (Linux 5.3+, Python 3.9+)"""
+    return hasattr(os, "pidfd_open")
+
+
+def _pidfd_open(pid):
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+async def wait_for_exit(km, poll_interval=1):
+    """Wait until the kernel process of a kernel manager exits.
+
+    Where supported, the process is watched through a pidfd on the event
+    loop, so the exit is noticed as soon as it happens. Otherwise, or if the
+    process is not known, km.is_alive() is polled every poll_interval seconds.
+    """
+    pid = kernel_pid(km)
+    fd = _pidfd_open(pid) if pid is not None else None
+    if fd is None:
+        while await ensure_async(km.is_alive()):
+            await asyncio.sleep(poll_interval)
+        return
+    loop = asyncio.get_event_loop()
+    exited = loop.create_future()
+    loop.add_reader(fd, lambda: exited.done() or exited.set_result(None))
+    try:
+        await exited
+    finally:
+        loop.remove_reader(fd)
+        os.close(fd)
+
+
+__all__ = [
+    "exit_notification_supported",
+    "wait_for_exit",
+]
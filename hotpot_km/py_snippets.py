@@ -1,17 +1,5 @@
-python_update_cwd_code = """
-import os;
-os.chdir({cwd!r});
-del os;
-"""
-
-python_update_env_code = """
-import os;
-for key, value in {env!r}.items():
-    os.environ[key] = value;
-del key
-del value
-del os;
-"""
+import json
+from itertools import chain
 
 python_init_import_code = """
 import importlib
@@ -20,3 +8,218 @@ for name in {modules!r}:
     del name
 del importlib
 """
+
+python_init_bundle_code = """
+async def _hotpot_initialize(stages):
+    from IPython import get_ipython
+    shell = get_ipython()
+
+    class InitializationError(Exception):
+        pass
+
+    def fail(stage, e):
+        return InitializationError("%s: %s: %s" % (stage, type(e).__name__, e))
+
+    for stage, source in stages:
+        try:
+            cell = shell.transform_cell(source)
+        except Exception as e:
+            raise fail(stage, e) from e
+        result = await shell.run_cell_async(source, store_history=False, transformed_cell=cell)
+        error = result.error_before_exec or result.error_in_exec
+        if error is not None:
+            raise fail(stage, error) from error
+try:
+    await _hotpot_initialize({stages!r})
+finally:
+    del _hotpot_initialize
+"""
+
+python_update_kernel_code = """
+def _hotpot_update(cwd, env):
+    import os
+    if cwd is not None:
+        os.chdir(cwd)
+    for key, value in env.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
+try:
+    _hotpot_update({cwd!r}, {env!r})
+finally:
+    del _hotpot_update
+"""
+
+
+def _json_string(value):
+    # R and Julia accept the escapes of JSON strings, but not the
+    # surrogate pairs that ensure_ascii would produce
+    return json.dumps(str(value), ensure_ascii=False)
+
+
+class LanguageSnippets:
+    """Code for adapting and initializing pooled kernels of one language.
+
+    Subclasses return None from a method if the language cannot do it.
+    """
+
+    # File extension of kernel_pool_init files in the language, if any:
+    extension = None
+
+    def update_code(self, cwd, env):
+        """Code that changes directory to cwd (unless None), and updates the
+        environment variables in env, unsetting those set to None"""
+        return None
+
+    def import_code(self, modules):
+        """Code that imports a list of modules/packages"""
+        return None
+
+
+class PythonSnippets(LanguageSnippets):
+    extension = "py"
+
+    def update_code(self, cwd, env):
+        return python_update_kernel_code.format(cwd=cwd, env=env)
+
+    def import_code(self, modules):
+        return python_init_import_code.format(modules=list(modules))
+
+
+class RSnippets(LanguageSnippets):
+    extension = "R"
+
+    def update_code(self, cwd, env):
+        lines = []
+        if cwd is not None:
+            lines.append("setwd(%s)" % _json_string(cwd))
+        values = [
+            "%s = %s" % (_json_string(k), _json_string(v)) for k, v in env.items() if v is not None
+        ]
+        if values:
+            lines.append("Sys.setenv(%s)" % ", ".join(values))
+        unset = [_json_string(k) for k, v in env.items() if v is None]
+        if unset:
+            lines.append("Sys.unsetenv(c(%s))" % ", ".join(unset))
+        lines.append("invisible()")
+        return "\n".join(lines)
+
+    def import_code(self, modules):
+        lines = ["library(%s)" % _json_string(m) for m in modules]
+        lines.append("invisible()")
+        return "\n".join(lines)
+
+
+class JuliaSnippets(LanguageSnippets):
+    extension = "jl"
+
+    @staticmethod
+    def _string(value):
+        return _json_string(value).replace("$", "\\$")
+
+    def update_code(self, cwd, env):
+        lines = []
+        if cwd is not None:
+            lines.append("cd(%s)" % self._string(cwd))
+        for key, value in env.items():
+            if value is None:
+                lines.append("delete!(ENV, %s)" % self._string(key))
+            else:
+                lines.append("ENV[%s] = %s" % (self._string(key), self._string(value)))
+        lines.append("nothing")
+        return "\n".join(lines)
+
+    def import_code(self, modules):
+        lines = ["import %s" % m for m in modules]
+        lines.append("nothing")
+        return "\n".join(lines)
+
+
+class CppSnippets(LanguageSnippets):
+    """Snippets for the C++ interpreters of xeus-cling and xeus-cpp"""
+
+    extension = "cpp"
+
+    @staticmethod
+    def _string(value):
+        """A raw string literal of value, or None if it contains the delimiter"""
+        value = str(value)
+        if ')hotpot"' in value:
+            return None
+        return 'R"hotpot(%s)hotpot"' % (value,)
+
+    def update_code(self, cwd, env):
+        values = [v for v in chain([cwd], *env.items()) if v is not None]
+        if any(self._string(v) is None for v in values):
+            return None
+        lines = ["#include <cstdlib>", "#include <unistd.h>"]
+        if cwd is not None:
+            lines.append("chdir(%s);" % self._string(cwd))
+        for key, value in env.items():
+            if value is None:
+                lines.append("unsetenv(%s);" % self._string(key))
+            else:
+                lines.append("setenv(%s, %s, 1);" % (self._string(key), self._string(value)))
+        return "\n".join(lines)
+
+    def import_code(self, modules):
+        return "\n".join("#include <%s>" % m for m in modules)
+
+
+# Mapping of (lowercased) kernelspec language -> LanguageSnippets
+language_snippets = {
+    "python": PythonSnippets(),
+    "r": RSnippets(),
+    "julia": JuliaSnippets(),
+    "c++": CppSnippets(),
+}
+
+
+def register_language_snippets(language, snippets):
+    """Register the snippets used for kernels of a kernelspec language"""
+    language_snippets[language.lower()] = snippets
+
+
+def get_language_snippets(language):
+    """Get the snippets of a kernelspec language, or None if it is not supported"""
+    if not language:
+        return None
+    language = language.lower()
+    if language.startswith("c++") or language == "cpp":
+        # xeus-cling uses e.g. "C++17"
+        language = "c++"
+    return language_snippets.get(language)
+
+
+class InitStagesMixin:
+    """Building of the initialization stages, shared by the pooled managers.
+
+    Expects the python_imports and language_imports traits, and an
+    _init_bundles dict for caching the bundled code.
+    """
+
+    def _imports_stage(self, language):
+        """Get the (name, code) stage importing the configured modules of a language, if any"""
+        snippets = get_language_snippets(language)
+        if snippets is None:
+            return None
+        if language == "python":
+            name, modules = "python_imports", list(self.python_imports)
+        else:
+            name, modules = "language_imports", []
+        for key, value in self.language_imports.items():
+            if get_language_snippets(key) is snippets:
+                modules.extend(value)
+        code = modules and snippets.import_code(modules)
+        if not code:
+            return None
+        return name, code
+
+    def _init_bundle(self, key, stages):
+        """Get the code that runs the initialization stages of a Python kernel in one go"""
+        cached = self._init_bundles.get(key)
+        if cached is None or cached[0] != stages:
+            code = python_init_bundle_code.format(stages=stages)
+            cached = self._init_bundles[key] = (stages, code)
+        return cached[1]
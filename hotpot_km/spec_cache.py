@@ -0,0 +1,71 @@
+# coding: utf-8
+
+# Copyright (c) Vidar Tonaas Fauske.
+# Distributed under the terms of the Modified BSD License.
+"""Hotpot - Jupyter kernel manager helpers
+
+This module contains a cache of kernel specs.
+"""
+
+import os
+
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (path, None)
+    return (path, st.st_mtime_ns, st.st_size)
+
+
+class KernelSpecCache:
+    """Caches the kernel specs of a kernel spec manager.
+
+    Reading all kernel specs walks every kernelspec directory and parses every
+    kernel.json. The cached specs are instead reused until the modification
+    time of a kernelspec directory, of a kernel directory in one, or of a
+    kernel.json, changes.
+    """
+
+    def __init__(self, kernel_spec_manager):
+        self.kernel_spec_manager = kernel_spec_manager
+        self._specs = None
+        self._stamp = None
+
+    def _current_stamp(self):
+        kernel_dirs = getattr(self.kernel_spec_manager, "kernel_dirs", None)
+        if kernel_dirs is None:
+            # We cannot tell when the specs change
+            return None
+        stamp = []
+        for kernel_dir in kernel_dirs:
+            try:
+                stamp.append((kernel_dir, os.stat(kernel_dir).st_mtime_ns))
+                with os.scandir(kernel_dir) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            stamp.append((entry.path, entry.stat().st_mtime_ns))
+                            stamp.append(_file_stamp(os.path.join(entry.path, "kernel.json")))
+            except OSError:
+                stamp.append((kernel_dir, None))
+        return stamp
+
+    def get_all_specs(self):
+        """Get the kernel specs, as returned by KernelSpecManager.get_all_specs"""
+        stamp = self._current_stamp()
+        if self._specs is None or stamp is None or stamp != self._stamp:
+            self._specs = self.kernel_spec_manager.get_all_specs()
+            self._stamp = stamp
+        return self._specs
+
+    def get_language(self, kernel_name):
+        """Get the language of a kernel, or None if it is not known"""
+        spec = self.get_all_specs().get(kernel_name)
+        if spec is None:
+            return None
+        return spec["spec"].get("language")
+
+
+__all__ = [
+    "KernelSpecCache",
+]
@@ -0,0 +1,42 @@
+import asyncio
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from ..async_utils import FairSemaphore
+
+
+class TestFairSemaphore(AsyncTestCase):
+    @gen_test
+    async def test_round_robin(self):
+        sem = FairSemaphore(1)
+        order = []
+
+        async def work(key, i):
+            await sem.acquire(key)
+            try:
+                order.append((key, i))
+                await asyncio.sleep(0)
+            finally:
+                sem.release()
+
+        tasks = [asyncio.ensure_future(work("a", i)) for i in range(3)]
+        tasks += [asyncio.ensure_future(work("b", i)) for i in range(2)]
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, [("a", 0), ("a", 1), ("b", 0), ("a", 2), ("b", 1)])
+        self.assertEqual(sem._value, 1)
+
+    @gen_test
+    async def test_cancelled_waiter(self):
+        sem = FairSemaphore(1)
+        await sem.acquire("a")
+        waiter = asyncio.ensure_future(sem.acquire("a"))
+        other = asyncio.ensure_future(sem.acquire("b"))
+        await asyncio.sleep(0)
+        self.assertEqual(len(sem), 2)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        self.assertEqual(len(sem), 1)
+        sem.release()
+        await other
+        sem.release()
+        self.assertEqual(sem._value, 1)
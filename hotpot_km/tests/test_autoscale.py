@@ -0,0 +1,45 @@
+import math
+
+from ..autoscale import DemandTracker, allocate_targets
+
+
+def test_demand_no_arrivals():
+    tracker = DemandTracker(halflife=10)
+    assert tracker.rate("python3", now=0) == 0
+
+
+def test_demand_decays():
+    tracker = DemandTracker(halflife=10)
+    tracker.record("python3", now=0)
+    tracker.record("python3", now=0)
+    initial = tracker.rate("python3", now=0)
+    assert initial == 2 * math.log(2) / 10
+    assert math.isclose(tracker.rate("python3", now=10), initial / 2)
+    assert math.isclose(tracker.rate("python3", now=20), initial / 4)
+    assert tracker.rate("other", now=20) == 0
+
+
+def test_demand_steady_rate():
+    tracker = DemandTracker(halflife=60)
+    # One request per second for a long time should estimate ~1/s
+    for t in range(1000):
+        tracker.record("python3", now=t)
+    assert math.isclose(tracker.rate("python3", now=999), 1, rel_tol=0.05)
+
+
+def test_allocate_bounds():
+    bounds = {"a": (1, 4), "b": (0, 2), "c": (0, 3)}
+    targets = allocate_targets({"a": 0, "b": 5.5, "c": 1.6}, bounds)
+    assert targets == {"a": 1, "b": 2, "c": 2}
+    targets = allocate_targets({"a": 0.2, "b": 0.4, "c": 0.5}, bounds)
+    assert targets == {"a": 1, "b": 0, "c": 1}
+
+
+def test_allocate_capacity():
+    bounds = {"a": (0, 4), "b": (0, 4)}
+    targets = allocate_targets({"a": 1, "b": 3}, bounds, capacity=4)
+    assert targets == {"a": 1, "b": 3}
+    targets = allocate_targets({"a": 1, "b": 3}, bounds, capacity=3)
+    assert targets == {"a": 0, "b": 3}
+    targets = allocate_targets({"a": 1, "b": 3}, bounds, capacity=-1)
+    assert targets == {"a": 0, "b": 0}
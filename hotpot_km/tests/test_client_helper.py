@@ -0,0 +1,156 @@
+import asyncio
+from unittest import mock
+
+from jupyter_client import AsyncKernelManager
+from tornado.testing import AsyncTestCase, gen_test
+
+from ..client_helper import (
+    ClientRegistry,
+    ExecClient,
+    ExecutionError,
+    OutputBuffer,
+    default_registry,
+)
+
+
+class TestExecClientPipelining(AsyncTestCase):
+    @gen_test(timeout=60)
+    async def test_execute_many(self):
+        km = AsyncKernelManager()
+        await km.start_kernel()
+        try:
+            client = ExecClient(km, _store_outputs=True)
+            async with client.setup_kernel():
+                replies = await client.execute_many(
+                    ["import time; time.sleep(0.2); print(1)", "print(2)", "", "print(3)"]
+                )
+                statuses = [r and r["content"]["status"] for r in replies]
+                self.assertEqual(statuses, ["ok", "ok", None, "ok"])
+                self.assertEqual([out["text"] for out in client._outputs], ["1\n", "2\n", "3\n"])
+                self.assertFalse(client._pending)
+
+                # The first failure is raised, and the rest are aborted by the kernel
+                with self.assertRaises(ExecutionError) as e:
+                    await client.execute_many(["1 / 0", "print(4)"])
+                self.assertEqual(e.exception.ename, "ZeroDivisionError")
+                self.assertEqual(len(client._outputs), 4)
+                self.assertEqual(client._outputs[-1]["output_type"], "error")
+
+                # The client is still usable afterwards
+                await client.execute("print(5)")
+                self.assertEqual(client._outputs[-1]["text"], "5\n")
+            self.assertIsNone(client.kc)
+        finally:
+            await km.shutdown_kernel(now=True)
+
+    @gen_test(timeout=60)
+    async def test_aborted_without_idle(self):
+        km = AsyncKernelManager()
+        await km.start_kernel()
+        try:
+            client = ExecClient(km, iopub_timeout=30)
+            async with client.setup_kernel():
+                msg_ids = []
+                execute = client.kc.execute
+                process_message = client.process_message
+
+                def record_execute(*args, **kwargs):
+                    msg_ids.append(execute(*args, **kwargs))
+                    return msg_ids[-1]
+
+                def skip_idle(msg, outs=None):
+                    # As kernels that do not publish a status for aborted requests
+                    idle = process_message(msg, outs)
+                    return idle and msg["parent_header"]["msg_id"] != msg_ids[1]
+
+                with mock.patch.object(client.kc, "execute", side_effect=record_execute):
+                    with mock.patch.object(client, "process_message", side_effect=skip_idle):
+                        with self.assertRaises(ExecutionError):
+                            await asyncio.wait_for(client.execute_many(["1 / 0", "print(1)"]), 10)
+        finally:
+            await km.shutdown_kernel(now=True)
+
+    @gen_test(timeout=60)
+    async def test_router_failure(self):
+        km = AsyncKernelManager()
+        await km.start_kernel()
+        try:
+            client = ExecClient(km, _store_outputs=True)
+            async with client.setup_kernel():
+                with mock.patch.object(
+                    client.kc.iopub_channel, "get_msg", side_effect=[ValueError("bad message")]
+                ):
+                    with self.assertRaises(ValueError):
+                        await client.execute("print(1)")
+                self.assertIsNone(client._routers)
+
+                # The routers are restarted by the next execute
+                await client.execute("print(2)")
+                self.assertEqual(client._outputs[-1]["text"], "2\n")
+        finally:
+            await km.shutdown_kernel(now=True)
+
+    @gen_test(timeout=60)
+    async def test_client_registry(self):
+        km = AsyncKernelManager()
+        await km.start_kernel()
+        try:
+            registry = ClientRegistry()
+            client = ExecClient(km, registry=registry)
+            async with client.setup_kernel():
+                self.assertIn(client, registry)
+                self.assertNotIn(client, default_registry)
+            self.assertEqual(len(registry), 0)
+
+            await client.start_new_kernel_client()
+            await client.execute("pass")
+            registry.close_all()
+            self.assertIsNone(client.kc)
+            self.assertEqual(len(registry), 0)
+        finally:
+            await km.shutdown_kernel(now=True)
+
+    @gen_test(timeout=60)
+    async def test_execute_stream(self):
+        km = AsyncKernelManager()
+        await km.start_kernel()
+        try:
+            client = ExecClient(km, _store_outputs=True)
+            async with client.setup_kernel():
+                texts = []
+                code = (
+                    "import time\nfor i in range(3):\n    print(i, flush=True)\n    time.sleep(0.1)"
+                )
+                async for out in client.execute_stream(code):
+                    texts.append(out["text"])
+                self.assertEqual("".join(texts), "0\n1\n2\n")
+                # Streamed outputs are not stored
+                self.assertEqual(client._outputs, [])
+
+                outs = []
+                with self.assertRaises(ExecutionError):
+                    async for out in client.execute_stream("1 / 0"):
+                        outs.append(out)
+                self.assertEqual([out["output_type"] for out in outs], ["error"])
+        finally:
+            await km.shutdown_kernel(now=True)
+
+
+def test_output_buffer():
+    buffer = OutputBuffer(max_count=3)
+    for i in range(5):
+        buffer.append(dict(output_type="stream", name="stdout", text=str(i)))
+    assert [out["text"] for out in buffer] == ["2", "3", "4"]
+    assert buffer.dropped == 2
+    assert buffer.nbytes == 3
+
+    buffer = OutputBuffer(max_bytes=10)
+    for text in ["aaaa", "bbbb", "cccc", "d" * 20]:
+        buffer.append(dict(output_type="stream", name="stdout", text=text))
+        assert buffer.nbytes <= 10 or len(buffer) == 1
+    # The latest output is always kept
+    assert [out["text"] for out in buffer] == ["d" * 20]
+    buffer.append(dict(output_type="display_data", data={"text/plain": "e"}, metadata={}))
+    assert len(buffer) == 1 and buffer.nbytes == 1
+    assert isinstance(ExecClient(max_stored_outputs=2)._outputs, OutputBuffer)
+    assert ExecClient()._outputs == []
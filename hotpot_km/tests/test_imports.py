@@ -0,0 +1,59 @@
+import re
+import subprocess
+import sys
+
+import pytest
+
+# Budget for the cumulative time of `import hotpot_km`, in microseconds. This
+# is generous, as the package itself should only load its version.
+IMPORT_BUDGET_US = 200000
+
+
+def _import_in_subprocess(statement):
+    """The cumulative import times (us) by module, for a statement run in a new interpreter"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        m = re.match(r"import time:\s*\d+\s*\|\s*(\d+)\s*\|\s*(\S+)", line)
+        if m:
+            times[m.group(2)] = int(m.group(1))
+    return times
+
+
+def test_import_budget():
+    times = _import_in_subprocess("import hotpot_km")
+    assert times["hotpot_km"] < IMPORT_BUDGET_US
+    for module in ("hotpot_km.client_helper", "nbformat", "jupyter_server", "zmq"):
+        assert module not in times
+
+
+def test_manager_import_is_lazy():
+    times = _import_in_subprocess("from hotpot_km import PooledKernelManager")
+    # (import_module does not report to -X importtime, so check a dependency)
+    assert "hotpot_km.client_helper" in times
+    for module in ("nbformat", "jupyter_server", "hotpot_km.pooled_sync"):
+        assert module not in times
+
+
+def test_missing_attribute():
+    import hotpot_km
+
+    with pytest.raises(AttributeError):
+        hotpot_km.NotAManager
+    assert "PooledKernelManager" in dir(hotpot_km)
+
+
+def test_all_skips_unimportable(monkeypatch):
+    import hotpot_km
+
+    monkeypatch.delitem(vars(hotpot_km), "__all__", raising=False)
+    monkeypatch.setitem(hotpot_km._lazy_attributes, "NotAManager", ".not_a_module")
+    names = hotpot_km.__all__
+    assert "NotAManager" not in names
+    assert "PooledKernelManager" in names
+    assert names[0] == "__version__"
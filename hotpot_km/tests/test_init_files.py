@@ -0,0 +1,37 @@
+import os
+from unittest import mock
+
+from ..init_files import InitFileCache
+
+
+def test_cached_until_modified(tmp_path):
+    first = tmp_path / "first"
+    second = tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    with mock.patch("jupyter_core.paths.jupyter_config_path") as jcp:
+        jcp.return_value = [str(first), str(second)]
+        cache = InitFileCache()
+        scripts, empty = cache.get("python3", "py")
+        assert scripts == []
+
+        (second / "kernel_pool_init_python3.py").write_text("b = 1")
+        scripts, digest = cache.get("python3", "py")
+        assert scripts == [(second / "kernel_pool_init_python3.py", "b = 1")]
+        assert digest != empty
+
+        # The config path is only resolved once
+        jcp.return_value = []
+        with mock.patch("builtins.open", side_effect=AssertionError):
+            assert cache.get("python3", "py") == (scripts, digest)
+
+        path = first / "kernel_pool_init_python3.py"
+        path.write_text("a = 1")
+        scripts, digest = cache.get("python3", "py")
+        assert [code for _, code in scripts] == ["a = 1", "b = 1"]
+
+        path.write_text("a = 2")
+        os.utime(path, ns=(0, 0))
+        scripts, changed = cache.get("python3", "py")
+        assert [code for _, code in scripts] == ["a = 2", "b = 1"]
+        assert changed != digest
@@ -1,4 +1,5 @@
 import asyncio
+import os
 from contextlib import asynccontextmanager
 from unittest import mock
 from pathlib import Path
@@ -11,7 +12,7 @@ import pytest
 from tornado.testing import AsyncTestCase, gen_test
 from traitlets.config.loader import Config
 
-from ..client_helper import ExecClient
+from ..client_helper import ExecClient, ExecutionError
 
 try:
     from .. import (
@@ -158,4 +159,117 @@ class TestInitializePooled(AsyncTestCase):
                 [{"name": "stdout", "output_type": "stream", "text": "True\n"}],
             )
         finally:
-            await km.shutdown_all()
\ No newline at end of file
+            await km.shutdown_all()
+
+
+class TestInitializeReload(AsyncTestCase):
+    @gen_test(timeout=60)
+    async def test_reload_init_files(self):
+        with TemporaryDirectory() as tmp_dir:
+            c = Config()
+            c.PooledKernelManager.fill_delay = 0
+            c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 1}
+            c.PooledKernelManager.pool_reload_init_files = True
+            c.PooledKernelManager.pool_recycle_interval = 0.2
+
+            with mock.patch("jupyter_core.paths.jupyter_config_path") as jcp:
+                jcp.return_value = [tmp_dir]
+                init_file = Path(tmp_dir) / f"kernel_pool_init_{NATIVE_KERNEL_NAME}.py"
+                init_file.write_text("foo = 1")
+                km = PooledKernelManager(config=c)
+
+                try:
+                    await km.wait_for_pool()
+                    pool = km._pools[NATIVE_KERNEL_NAME]
+                    original = next(iter(pool)).kernel_id
+
+                    init_file.write_text("foo = 2")
+                    os.utime(init_file, ns=(0, 0))
+                    for _ in range(100):
+                        await asyncio.sleep(0.2)
+                        if original not in [entry.kernel_id for entry in pool.ready()]:
+                            break
+                    metrics = km.get_pool_metrics()[NATIVE_KERNEL_NAME]
+                    self.assertEqual(metrics["init_files_changed"], 1)
+                    self.assertEqual(metrics["recycled"], 1)
+
+                    kid = await km.start_kernel()
+                    self.assertNotEqual(kid, original)
+                    client = ExecClient(km.get_kernel(kid), _store_outputs=True)
+                    async with client.setup_kernel():
+                        await client.execute("print(foo)")
+                    self.assertEqual(
+                        client._outputs,
+                        [{"name": "stdout", "output_type": "stream", "text": "2\n"}],
+                    )
+                finally:
+                    await km.shutdown_all()
+
+
+class TestInitializeBundle(AsyncTestCase):
+    @gen_test(timeout=30)
+    async def test_single_execute(self):
+        with TemporaryDirectory() as tmp_dir:
+            c = Config()
+            c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 1}
+            c.PooledKernelManager.python_imports = ["turtle"]
+            c.PooledKernelManager.initialization_code = {
+                NATIVE_KERNEL_NAME: "%env HOTPOT_INIT=1\nbar = 2"
+            }
+
+            with mock.patch("jupyter_core.paths.jupyter_config_path") as jcp:
+                jcp.return_value = [tmp_dir]
+                init_file = Path(tmp_dir) / f"kernel_pool_init_{NATIVE_KERNEL_NAME}.py"
+                init_file.write_text("foo = bar + 1")
+                with mock.patch.object(
+                    ExecClient, "execute", autospec=True, side_effect=ExecClient.execute
+                ) as execute:
+                    km = PooledKernelManager(config=c)
+                    try:
+                        await km.wait_for_pool()
+                        self.assertEqual(execute.call_count, 1)
+
+                        kid = await km.start_kernel()
+                        client = ExecClient(km.get_kernel(kid), _store_outputs=True)
+                        async with client.setup_kernel():
+                            await client.execute(
+                                'import os, sys\n'
+                                'print(foo, os.environ["HOTPOT_INIT"], "turtle" in sys.modules)'
+                            )
+                        self.assertEqual(
+                            client._outputs,
+                            [{"name": "stdout", "output_type": "stream", "text": "3 1 True\n"}],
+                        )
+                    finally:
+                        await km.shutdown_all()
+
+    @gen_test(timeout=30)
+    async def test_top_level_await(self):
+        c = Config()
+        c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 1}
+        c.PooledKernelManager.initialization_code = {
+            NATIVE_KERNEL_NAME: "import asyncio\nawaited = await asyncio.sleep(0, result=4)"
+        }
+        km = PooledKernelManager(config=c)
+        try:
+            kid = await km.start_kernel()
+            client = ExecClient(km.get_kernel(kid), _store_outputs=True)
+            async with client.setup_kernel():
+                await client.execute("print(awaited)")
+            self.assertEqual(client._outputs[-1]["text"], "4\n")
+        finally:
+            await km.shutdown_all()
+
+    @gen_test(timeout=30)
+    async def test_failed_stage(self):
+        c = Config()
+        c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 1}
+        c.PooledKernelManager.initialization_code = {NATIVE_KERNEL_NAME: "1 / 0"}
+        km = PooledKernelManager(config=c)
+        try:
+            with self.assertRaises(ExecutionError) as cm:
+                await km.wait_for_pool()
+            self.assertEqual(cm.exception.ename, "InitializationError")
+            self.assertTrue(cm.exception.evalue.startswith("initialization_code: ZeroDivisionError"))
+        finally:
+            await km.shutdown_all()
@@ -0,0 +1,81 @@
+import asyncio
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from ..kernel_pool import KernelPool, PoolEntry, PoolVariant, kwargs_fingerprint
+
+
+def make_entry(name="python3"):
+    entry = PoolEntry(name)
+    entry.task = asyncio.get_event_loop().create_future()
+    return entry
+
+
+class TestKernelPool(AsyncTestCase):
+    @gen_test
+    async def test_pop_ready_first(self):
+        pool = KernelPool()
+        entries = [make_entry() for i in range(3)]
+        for entry in entries:
+            pool.add(entry)
+        self.assertEqual(len(pool), 3)
+
+        entries[2].task.set_result("c")
+        entries[1].task.set_result("b")
+        await asyncio.sleep(0)
+        self.assertEqual(list(pool), [entries[2], entries[1], entries[0]])
+
+        self.assertIs(pool.pop(), entries[2])
+        self.assertIs(pool.pop(), entries[1])
+        # Falls back to the entry that was launched first
+        self.assertIs(pool.pop(), entries[0])
+        self.assertEqual(len(pool), 0)
+        with self.assertRaises(IndexError):
+            pool.pop()
+
+    @gen_test
+    async def test_failed_last(self):
+        pool = KernelPool()
+        failed, starting, ready = entries = [make_entry() for i in range(3)]
+        for entry in entries:
+            pool.add(entry)
+        failed.task.set_exception(RuntimeError("failed"))
+        ready.task.set_result("a")
+        await asyncio.sleep(0)
+
+        self.assertIs(pool.pop_last(), failed)
+        self.assertIs(pool.pop_last(), starting)
+        self.assertIs(pool.pop_last(), ready)
+
+    @gen_test
+    async def test_remove(self):
+        pool = KernelPool()
+        entries = [make_entry() for i in range(3)]
+        for entry in entries:
+            pool.add(entry)
+        entries[0].task.set_result("a")
+        await asyncio.sleep(0)
+
+        pool.remove(entries[0])
+        pool.remove(entries[1])
+        # Removing an entry not in the pool is a no-op
+        pool.remove(entries[1])
+        self.assertNotIn(entries[0], pool)
+        self.assertEqual(list(pool), [entries[2]])
+        # Completion of removed entries is ignored
+        entries[1].task.set_result("b")
+        await asyncio.sleep(0)
+        self.assertEqual(len(pool), 1)
+
+
+def test_kwargs_fingerprint():
+    assert kwargs_fingerprint(dict(a=1, b=[2])) == kwargs_fingerprint(dict(b=[2], a=1))
+    assert kwargs_fingerprint(dict(a=1)) != kwargs_fingerprint(dict(a=2))
+    assert kwargs_fingerprint(dict(a=1, cwd="/x"), ("cwd",)) == kwargs_fingerprint(dict(a=1))
+
+
+def test_variant_adaptation_cost():
+    variant = PoolVariant("python3", dict(cwd="/a", env=dict(A="1", B="2")))
+    assert variant.base_fingerprint == kwargs_fingerprint({})
+    assert variant.adaptation_cost(dict(cwd="/a", env=dict(A="1"))) == 0
+    assert variant.adaptation_cost(dict(cwd="/b", env=dict(A="3", C="4"))) == 3
@@ -1,17 +1,22 @@
+import asyncio
 from contextlib import asynccontextmanager
 from subprocess import PIPE
+from unittest import mock
 
-from tornado.testing import gen_test
+import pytest
+from tornado.testing import AsyncTestCase, gen_test
 from traitlets.config.loader import Config
 
 try:
     from .. import (
+        KernelQuotaException,
         LimitedKernelManager,
         MaximumKernelsException,
     )
 except ImportError:
     pass
 
+from ..memory import memory_supported
 from .utils import TestAsyncKernelManager
 
 
@@ -93,3 +98,195 @@ class TestLimitedKernelManagerApplied(TestAsyncKernelManager):
             await km.shutdown_all()
             for kid in kids:
                 self.assertNotIn(kid, km)
+
+
+# Test that start requests can wait for capacity
+class TestLimitedKernelManagerQueued(AsyncTestCase):
+    def _get_km(self, wait):
+        c = Config()
+        c.LimitedKernelManager.max_kernels = 2
+        c.LimitedKernelManager.max_kernels_wait = wait
+        return LimitedKernelManager(config=c)
+
+    @gen_test(timeout=60)
+    async def test_wait_for_capacity(self):
+        km = self._get_km(20)
+        try:
+            kids = [await km.start_kernel(stdout=PIPE, stderr=PIPE) for i in range(2)]
+            first = asyncio.ensure_future(km.start_kernel(stdout=PIPE, stderr=PIPE))
+            second = asyncio.ensure_future(km.start_kernel(stdout=PIPE, stderr=PIPE))
+            await asyncio.sleep(0.5)
+            self.assertFalse(first.done())
+            self.assertEqual(km.get_admission_metrics()["queued"], 2)
+
+            # Requests are admitted in order as capacity frees up
+            await km.shutdown_kernel(kids.pop())
+            kids.append(await first)
+            self.assertFalse(second.done())
+            await km.shutdown_kernel(kids.pop(0))
+            kids.append(await second)
+
+            metrics = km.get_admission_metrics()
+            self.assertEqual(metrics["queued"], 0)
+            self.assertEqual(metrics["admitted"], 2)
+            self.assertGreater(metrics["wait_max"], 0.5)
+            self.assertEqual(len(km), 2)
+        finally:
+            await km.shutdown_all()
+
+    @gen_test(timeout=60)
+    async def test_concurrent_starts(self):
+        km = self._get_km(0)
+        try:
+            # Kernels that are still starting count towards the maximum
+            results = await asyncio.gather(
+                *(km.start_kernel(stdout=PIPE, stderr=PIPE) for i in range(4)),
+                return_exceptions=True,
+            )
+            failed = [r for r in results if isinstance(r, MaximumKernelsException)]
+            self.assertEqual(len(failed), 2)
+            self.assertEqual(len(km), 2)
+            metrics = km.get_admission_metrics()
+            self.assertEqual(metrics["active"], 2)
+            self.assertEqual(metrics["reserved"], 0)
+        finally:
+            await km.shutdown_all()
+
+    @gen_test(timeout=60)
+    async def test_wait_timeout(self):
+        km = self._get_km(0.5)
+        try:
+            for i in range(2):
+                await km.start_kernel(stdout=PIPE, stderr=PIPE)
+            with self.assertRaises(MaximumKernelsException):
+                await km.start_kernel(stdout=PIPE, stderr=PIPE)
+            metrics = km.get_admission_metrics()
+            self.assertEqual(metrics["queued"], 0)
+            self.assertEqual(metrics["timeouts"], 1)
+        finally:
+            await km.shutdown_all()
+
+    @gen_test(timeout=10)
+    async def test_release_at_timeout(self):
+        km = self._get_km(0.1)
+        # As if two kernels were being started
+        km._reserved = 2
+        loop = asyncio.get_event_loop()
+        call_later = loop.call_later
+
+        def timeout_then_release(delay, callback):
+            def both():
+                callback()
+                # Capacity frees up before the timed out request resumes
+                km._release_capacity()
+
+            return call_later(delay, both)
+
+        with mock.patch.object(loop, "call_later", timeout_then_release):
+            with self.assertRaises(MaximumKernelsException):
+                await km._reserve_capacity()
+        self.assertEqual(km._reserved, 1)
+        self.assertFalse(km._admission_queue)
+
+    @gen_test(timeout=10)
+    async def test_release_at_cancel(self):
+        km = self._get_km(10)
+        km._reserved = 2
+        waiting = asyncio.ensure_future(km._reserve_capacity())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        km._release_capacity()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual(km._reserved, 1)
+        self.assertFalse(km._admission_queue)
+
+# Test that quotas limit kernels per owner and per kernel name
+class TestLimitedKernelManagerQuota(AsyncTestCase):
+    @gen_test(timeout=60)
+    async def test_owner_quota(self):
+        c = Config()
+        c.LimitedKernelManager.max_kernels_per_owner = 1
+        km = LimitedKernelManager(config=c)
+        try:
+            kid = await km.start_kernel(owner="alice", stdout=PIPE, stderr=PIPE)
+            self.assertEqual(km.get_kernel_owner(kid), "alice")
+            with self.assertRaises(KernelQuotaException):
+                await km.start_kernel(owner="alice", stdout=PIPE, stderr=PIPE)
+            # Other owners, and kernels without owners, are not affected
+            await km.start_kernel(owner="bob", stdout=PIPE, stderr=PIPE)
+            await km.start_kernel(stdout=PIPE, stderr=PIPE)
+
+            await km.shutdown_kernel(kid)
+            await km.start_kernel(owner="alice", stdout=PIPE, stderr=PIPE)
+            self.assertEqual(len(km), 3)
+        finally:
+            await km.shutdown_all()
+
+    @gen_test(timeout=60)
+    async def test_name_quota(self):
+        c = Config()
+        c.LimitedKernelManager.max_kernels_per_name = {"python3": 1}
+        c.LimitedKernelManager.kernel_owner = lambda name, kwargs: "team-" + kwargs["owner"]
+        km = LimitedKernelManager(config=c)
+        try:
+            kid = await km.start_kernel(
+                kernel_name="python3", owner="alice", stdout=PIPE, stderr=PIPE
+            )
+            self.assertEqual(km.get_kernel_owner(kid), "team-alice")
+            with self.assertRaises(KernelQuotaException):
+                await km.start_kernel(kernel_name="python3", owner="bob", stdout=PIPE, stderr=PIPE)
+            self.assertEqual(len(km), 1)
+        finally:
+            await km.shutdown_all()
+
+
+# Test that the memory budget limits kernels
+@pytest.mark.skipif(not memory_supported(), reason="Requires /proc")
+class TestLimitedKernelManagerMemory(AsyncTestCase):
+    @gen_test(timeout=60)
+    async def test_breach_memory(self):
+        c = Config()
+        c.LimitedKernelManager.max_memory = 1
+        c.LimitedKernelManager.memory_sample_interval = 0.1
+        km = LimitedKernelManager(config=c)
+        try:
+            kid = await km.start_kernel(stdout=PIPE, stderr=PIPE)
+            # Wait for the kernel to be measured in the background
+            for _ in range(50):
+                await asyncio.sleep(0.1)
+                if kid in (km._memory_sample or {}):
+                    break
+            self.assertGreater(km.get_kernel_memory()[kid], 0)
+            with self.assertRaises(MaximumKernelsException):
+                await km.start_kernel(stdout=PIPE, stderr=PIPE)
+
+            # Freeing the memory allows new kernels
+            await km.shutdown_kernel(kid)
+            kid = await km.start_kernel(stdout=PIPE, stderr=PIPE)
+            self.assertIn(kid, km)
+        finally:
+            await km.shutdown_all()
+
+    @gen_test(timeout=60)
+    async def test_admit_when_memory_drops(self):
+        c = Config()
+        c.LimitedKernelManager.max_memory = 1
+        c.LimitedKernelManager.memory_sample_interval = 0.1
+        c.LimitedKernelManager.max_kernels_wait = 30
+        km = LimitedKernelManager(config=c)
+        try:
+            kid = await km.start_kernel(stdout=PIPE, stderr=PIPE)
+            for _ in range(50):
+                await asyncio.sleep(0.1)
+                if kid in (km._memory_sample or {}):
+                    break
+            waiting = asyncio.ensure_future(km.start_kernel(stdout=PIPE, stderr=PIPE))
+            await asyncio.sleep(0.3)
+            self.assertFalse(waiting.done())
+
+            # The next measurement admits the waiting request
+            km.max_memory = 2 ** 40
+            self.assertIn(await asyncio.wait_for(waiting, 10), km)
+        finally:
+            await km.shutdown_all()
@@ -1,10 +1,15 @@
+import asyncio
+import threading
+import time
 from contextlib import contextmanager
 from subprocess import PIPE
+from unittest import TestCase
 
 from tornado.testing import gen_test
 from traitlets.config.loader import Config
 
 from .. import (
+    KernelQuotaException,
     SyncLimitedKernelManager,
     MaximumKernelsException,
 )
@@ -88,3 +93,65 @@ class TestLimitedKernelManagerApplied(TestKernelManager):
             km.shutdown_all()
             for kid in kids:
                 self.assertNotIn(kid, km)
+
+
+# Test that start requests can wait for capacity
+class TestLimitedKernelManagerQueued(TestCase):
+    def _get_km(self, wait):
+        c = Config()
+        c.SyncLimitedKernelManager.max_kernels = 1
+        c.SyncLimitedKernelManager.max_kernels_wait = wait
+        return SyncLimitedKernelManager(config=c)
+
+    def test_wait_for_capacity(self):
+        km = self._get_km(20)
+        try:
+            kid = km.start_kernel(stdout=PIPE, stderr=PIPE)
+
+            def release():
+                time.sleep(0.5)
+                asyncio.set_event_loop(asyncio.new_event_loop())
+                km.shutdown_kernel(kid)
+
+            thread = threading.Thread(target=release)
+            thread.start()
+            try:
+                new_kid = km.start_kernel(stdout=PIPE, stderr=PIPE)
+            finally:
+                thread.join()
+            self.assertNotIn(kid, km)
+            self.assertIn(new_kid, km)
+            metrics = km.get_admission_metrics()
+            self.assertEqual(metrics["admitted"], 1)
+            self.assertGreater(metrics["wait_max"], 0.4)
+        finally:
+            km.shutdown_all()
+
+    def test_wait_timeout(self):
+        km = self._get_km(0.5)
+        try:
+            km.start_kernel(stdout=PIPE, stderr=PIPE)
+            with self.assertRaises(MaximumKernelsException):
+                km.start_kernel(stdout=PIPE, stderr=PIPE)
+            self.assertEqual(km.get_admission_metrics()["timeouts"], 1)
+        finally:
+            km.shutdown_all()
+
+
+# Test that quotas limit kernels per owner
+class TestLimitedKernelManagerQuota(TestCase):
+    def test_owner_quota(self):
+        c = Config()
+        c.SyncLimitedKernelManager.max_kernels_per_owner = 1
+        km = SyncLimitedKernelManager(config=c)
+        try:
+            kid = km.start_kernel(owner="alice", stdout=PIPE, stderr=PIPE)
+            with self.assertRaises(KernelQuotaException):
+                km.start_kernel(owner="alice", stdout=PIPE, stderr=PIPE)
+            km.start_kernel(owner="bob", stdout=PIPE, stderr=PIPE)
+
+            km.shutdown_kernel(kid)
+            km.start_kernel(owner="alice", stdout=PIPE, stderr=PIPE)
+            self.assertEqual(len(km), 2)
+        finally:
+            km.shutdown_all(now=True)
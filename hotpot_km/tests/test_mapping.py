@@ -139,7 +139,7 @@ class TestMappingKernelManagerApplied(TestAsyncKernelManager):
             self.assertEqual(len(km._pools[NATIVE_KERNEL_NAME]), 2)
             self.assertEqual(len(km), 2)
 
-            kid = await km._pools[NATIVE_KERNEL_NAME][0]
+            kid = await next(iter(km._pools[NATIVE_KERNEL_NAME]))
 
             culled = await self.get_cull_status(km, kid)  # in pool, should not be culled
             assert not culled
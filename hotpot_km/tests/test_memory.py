@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from ..memory import memory_supported, process_tree_rss
+
+
+pytestmark = pytest.mark.skipif(not memory_supported(), reason="Requires /proc")
+
+
+def test_process_tree_rss():
+    child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        rss = process_tree_rss({"self": os.getpid(), "child": child.pid})
+        assert rss["child"] > 0
+        # Our own tree includes the child process
+        assert rss["self"] > rss["child"]
+    finally:
+        child.kill()
+        child.wait()
+
+
+def test_missing_process():
+    child = subprocess.Popen([sys.executable, "-c", "pass"])
+    child.wait()
+    assert process_tree_rss({"gone": child.pid, "none": None}) == {"gone": 0, "none": 0}
@@ -1,9 +1,14 @@
 import asyncio
+import os
+import signal
 from contextlib import asynccontextmanager
 from subprocess import PIPE
-from unittest import TestCase
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
 
 from jupyter_client.kernelspec import NATIVE_KERNEL_NAME
+import nbformat
+from nbformat.v4 import new_code_cell, new_notebook
 import pytest
 from tornado.testing import AsyncTestCase, gen_test
 from traitlets.config.loader import Config
@@ -16,6 +21,9 @@ try:
 except ImportError:
     pass
 
+from ..client_helper import ExecClient
+from ..kernel_pool import kwargs_fingerprint
+from ..process_exit import exit_notification_supported
 from .utils import async_shutdown_all_direct, TestAsyncKernelManager
 
 # Test that it works as normal with default config
@@ -93,6 +101,22 @@ class TestPooledKernelManagerApplied(TestAsyncKernelManager):
             km.kernel_pools = {NATIVE_KERNEL_NAME: 3}
             self.assertEqual(len(km._pools[NATIVE_KERNEL_NAME]), 3)
 
+    @gen_test(timeout=60)
+    async def test_pooled_index(self):
+        async with self._get_tcp_km() as km:
+            pooled = [await entry for entry in km._pools[NATIVE_KERNEL_NAME]]
+            self.assertEqual(set(km._pooled_kernels), set(pooled))
+
+            kid = await km.start_kernel(stdout=PIPE, stderr=PIPE)
+            self.assertIn(kid, pooled)
+            self.assertNotIn(kid, km._pooled_kernels)
+
+            # Shutting down a pooled kernel removes it from the pool
+            other = next(k for k in pooled if k != kid)
+            await km.shutdown_kernel(other)
+            self.assertNotIn(other, km._pooled_kernels)
+            self.assertNotIn(other, [e.kernel_id for e in km._pools[NATIVE_KERNEL_NAME]])
+
     @gen_test(timeout=60)
     async def test_breach_max(self):
         async with self._get_tcp_km() as km:
@@ -197,3 +221,509 @@ class TestPooledKernelManagerStrict(AsyncTestCase):
         finally:
             await km.shutdown_all()
         self.assertNotIn(kid, km)
+
+
+class TestPooledKernelManagerAutoscale(AsyncTestCase):
+    @gen_test(timeout=60)
+    async def test_grow_and_shrink(self):
+        c = Config()
+        c.LimitedKernelManager.max_kernels = 4
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 2}
+        c.PooledKernelManager.pool_autoscale = True
+        c.PooledKernelManager.pool_autoscale_halflife = 1
+        c.PooledKernelManager.pool_autoscale_interval = 0.5
+        km = PooledKernelManager(config=c)
+
+        try:
+            # No demand yet, so nothing is pooled
+            self.assertEqual(len(km._pools[NATIVE_KERNEL_NAME]), 0)
+            kid = await km.start_kernel(stdout=PIPE, stderr=PIPE)
+            self.assertIn(kid, km)
+            # Demand registered, pool grows up to the kernel_pools value
+            self.assertEqual(len(km._pools[NATIVE_KERNEL_NAME]), 2)
+            await km.wait_for_pool()
+
+            # Without further demand, the pool shrinks again
+            for _ in range(40):
+                await asyncio.sleep(0.5)
+                if not km._pools[NATIVE_KERNEL_NAME]:
+                    break
+            self.assertEqual(len(km._pools[NATIVE_KERNEL_NAME]), 0)
+            await asyncio.gather(*km._discarded)
+        finally:
+            await km.shutdown_all()
+
+
+class TestPooledKernelManagerFillLimit(AsyncTestCase):
+    @gen_test(timeout=60)
+    async def test_limited_fill(self):
+        c = Config()
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 3}
+        c.PooledKernelManager.max_concurrent_fills = 1
+        km = PooledKernelManager(config=c)
+
+        try:
+            await asyncio.sleep(0.1)
+            # One is started, the others are queued
+            self.assertEqual(len(km._fill_limiter), 2)
+            await km.wait_for_pool()
+            self.assertEqual(len(km._fill_limiter), 0)
+            self.assertEqual(len(km), 3)
+        finally:
+            await km.shutdown_all()
+
+    @gen_test(timeout=60)
+    async def test_enable_limit(self):
+        c = Config()
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 2}
+        km = PooledKernelManager(config=c)
+
+        try:
+            km.max_concurrent_fills = 1
+            await asyncio.wait_for(km.wait_for_pool(), 30)
+            self.assertEqual(len(km), 2)
+        finally:
+            await km.shutdown_all()
+
+
+class TestPooledKernelManagerHealth(AsyncTestCase):
+    @gen_test(timeout=60)
+    async def test_replace_dead_kernel(self):
+        c = Config()
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 2}
+        c.PooledKernelManager.pool_health_check_interval = 0.5
+        c.PooledKernelManager.pool_health_check_heartbeat = True
+        c.PooledKernelManager.pool_watch_exits = False
+        km = PooledKernelManager(config=c)
+
+        try:
+            await km.wait_for_pool()
+            pool = km._pools[NATIVE_KERNEL_NAME]
+            kids = [entry.kernel_id for entry in pool]
+            dead = kids[0]
+            await km.get_kernel(dead).signal_kernel(getattr(signal, "SIGKILL", signal.SIGTERM))
+
+            for _ in range(20):
+                await asyncio.sleep(0.5)
+                if dead not in km:
+                    break
+            self.assertNotIn(dead, km)
+            self.assertNotIn(dead, km._pooled_kernels)
+            self.assertEqual(len(pool), 2)
+            self.assertIn(kids[1], [entry.kernel_id for entry in pool])
+
+            metrics = km.get_pool_metrics()[NATIVE_KERNEL_NAME]
+            self.assertEqual(metrics["health_check_failures"], 1)
+            self.assertGreaterEqual(metrics["health_checks"], 2)
+            self.assertEqual(metrics["size"], 2)
+        finally:
+            await km.shutdown_all()
+
+    @pytest.mark.skipif(not exit_notification_supported(), reason="Requires pidfd")
+    @gen_test(timeout=60)
+    async def test_exit_notification(self):
+        c = Config()
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 2}
+        km = PooledKernelManager(config=c)
+
+        try:
+            await km.wait_for_pool()
+            pool = km._pools[NATIVE_KERNEL_NAME]
+            dead = next(iter(pool)).kernel_id
+            await km.get_kernel(dead).signal_kernel(signal.SIGKILL)
+
+            for _ in range(50):
+                await asyncio.sleep(0.02)
+                if dead not in km:
+                    break
+            self.assertNotIn(dead, km)
+            self.assertEqual(len(pool), 2)
+            self.assertEqual(km.get_pool_metrics()[NATIVE_KERNEL_NAME]["died"], 1)
+        finally:
+            await km.shutdown_all()
+
+
+class TestPooledKernelManagerRecycle(AsyncTestCase):
+    @gen_test(timeout=90)
+    async def test_max_age(self):
+        c = Config()
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 2}
+        c.PooledKernelManager.pool_max_age = 1
+        c.PooledKernelManager.pool_recycle_interval = 0.5
+        km = PooledKernelManager(config=c)
+
+        try:
+            await km.wait_for_pool()
+            pool = km._pools[NATIVE_KERNEL_NAME]
+            original = {entry.kernel_id for entry in pool}
+
+            for _ in range(120):
+                await asyncio.sleep(0.25)
+                # Old kernels are only removed once their replacement is ready
+                self.assertEqual(pool.count_ready(), 2)
+                self.assertLessEqual(len(km._recycling[NATIVE_KERNEL_NAME]), 1)
+                if not original & {entry.kernel_id for entry in pool}:
+                    break
+            self.assertFalse(original & {entry.kernel_id for entry in pool})
+            self.assertGreaterEqual(km.get_pool_metrics()[NATIVE_KERNEL_NAME]["recycled"], 2)
+            await asyncio.gather(*km._discarded)
+            for kid in original:
+                self.assertNotIn(kid, km)
+        finally:
+            await km.shutdown_all()
+
+    @gen_test(timeout=90)
+    async def test_max_age_variant(self):
+        c = Config()
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.pool_variants = {NATIVE_KERNEL_NAME: [dict(kwargs=dict(env={}))]}
+        c.PooledKernelManager.pool_max_age = 1
+        c.PooledKernelManager.pool_recycle_interval = 0.5
+        km = PooledKernelManager(config=c)
+
+        try:
+            await km.wait_for_pool()
+            pool = km._variants[NATIVE_KERNEL_NAME, kwargs_fingerprint(dict(env={}))].pool
+            original = {entry.kernel_id for entry in pool}
+
+            for _ in range(120):
+                await asyncio.sleep(0.25)
+                if not original & {entry.kernel_id for entry in pool}:
+                    break
+            self.assertFalse(original & {entry.kernel_id for entry in pool})
+            self.assertEqual(pool.count_ready(), 1)
+            self.assertGreaterEqual(km.get_pool_metrics()[NATIVE_KERNEL_NAME]["recycled"], 1)
+        finally:
+            await km.shutdown_all()
+
+    @gen_test(timeout=90)
+    async def test_config_change(self):
+        c = Config()
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 2}
+        km = PooledKernelManager(config=c)
+
+        try:
+            await km.wait_for_pool()
+            pool = km._pools[NATIVE_KERNEL_NAME]
+            original = {entry.kernel_id for entry in pool}
+
+            km.initialization_code = {NATIVE_KERNEL_NAME: "rotated = True"}
+            for _ in range(120):
+                await asyncio.sleep(0.25)
+                # The pool keeps its depth during the rollout
+                self.assertEqual(pool.count_ready(), 2)
+                self.assertLessEqual(len(km._recycling[NATIVE_KERNEL_NAME]), 1)
+                if not original & {entry.kernel_id for entry in pool}:
+                    break
+            self.assertFalse(original & {entry.kernel_id for entry in pool})
+            await asyncio.gather(*km._discarded)
+            for kid in original:
+                self.assertNotIn(kid, km)
+
+            kid = await km.start_kernel()
+            client = ExecClient(km.get_kernel(kid), _store_outputs=True)
+            async with client.setup_kernel():
+                await client.execute("print(rotated)")
+            self.assertEqual(client._outputs[0]["text"], "True\n")
+        finally:
+            await km.shutdown_all()
+
+    @gen_test(timeout=60)
+    async def test_failing_config(self):
+        c = Config()
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 1}
+        km = PooledKernelManager(config=c)
+
+        try:
+            await km.wait_for_pool()
+            pool = km._pools[NATIVE_KERNEL_NAME]
+            original = {entry.kernel_id for entry in pool}
+
+            km.initialization_code = {NATIVE_KERNEL_NAME: "1 / 0"}
+            recycling = list(km._recycling[NATIVE_KERNEL_NAME])
+            self.assertEqual(len(recycling), 1)
+            await asyncio.gather(*(entry.task for entry in recycling), return_exceptions=True)
+
+            # The failed replacement is shut down, and not retried
+            km._recycle_outdated()
+            self.assertFalse(km._recycling[NATIVE_KERNEL_NAME])
+            self.assertEqual(set(km.list_kernel_ids()), original)
+            self.assertEqual({entry.kernel_id for entry in pool}, original)
+        finally:
+            await km.shutdown_all()
+
+    @gen_test(timeout=60)
+    async def test_discard_while_recycling(self):
+        c = Config()
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.pool_variants = {NATIVE_KERNEL_NAME: [dict(kwargs=dict(env={}))]}
+        km = PooledKernelManager(config=c)
+
+        try:
+            await km.wait_for_pool()
+            km.initialization_code = {NATIVE_KERNEL_NAME: "rotated = True"}
+            recycling = list(km._recycling[NATIVE_KERNEL_NAME])
+            self.assertEqual(len(recycling), 1)
+
+            # Removing the variant also stops its replacements
+            km.pool_variants = {}
+            self.assertFalse(km._recycling[NATIVE_KERNEL_NAME])
+            await asyncio.gather(*(entry.task for entry in recycling))
+            await asyncio.gather(*km._discarded)
+            self.assertEqual(km.list_kernel_ids(), [])
+            self.assertFalse(km._pooled_kernels)
+        finally:
+            await km.shutdown_all()
+
+
+class TestPooledKernelManagerEvict(AsyncTestCase):
+    @gen_test(timeout=60)
+    async def test_evict_for_capacity(self):
+        c = Config()
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 2}
+        c.PooledKernelManager.max_kernels = 2
+        km = PooledKernelManager(config=c)
+
+        try:
+            await km.wait_for_pool()
+            pooled = [entry.kernel_id for entry in km._pools[NATIVE_KERNEL_NAME]]
+            # Kernels that bypass the pool take the place of idle pooled kernels
+            kid = await km.start_kernel(kernel_id="unpooled", stdout=PIPE, stderr=PIPE)
+            self.assertEqual(kid, "unpooled")
+            self.assertEqual(len(km), 2)
+            self.assertEqual(len([k for k in pooled if k in km]), 1)
+            self.assertEqual(km.get_pool_metrics()[NATIVE_KERNEL_NAME]["evicted"], 1)
+        finally:
+            await km.shutdown_all()
+
+
+class TestPooledKernelManagerQuota(AsyncTestCase):
+    @gen_test(timeout=60)
+    async def test_owner_quota(self):
+        c = Config()
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 2}
+        c.PooledKernelManager.max_kernels_per_owner = 1
+        km = PooledKernelManager(config=c)
+
+        try:
+            await km.wait_for_pool()
+            pooled = [entry.kernel_id for entry in km._pools[NATIVE_KERNEL_NAME]]
+            # Pooled kernels count once they are handed out
+            kid = await km.start_kernel(owner="alice")
+            self.assertIn(kid, pooled)
+            self.assertEqual(km.get_kernel_owner(kid), "alice")
+            with self.assertRaises(MaximumKernelsException):
+                await km.start_kernel(owner="alice")
+            self.assertEqual(len(km._pools[NATIVE_KERNEL_NAME]), 2)
+        finally:
+            await km.shutdown_all()
+
+
+class TestPooledKernelManagerClients(AsyncTestCase):
+    @gen_test(timeout=60)
+    async def test_connected_until_handout(self):
+        c = Config()
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 2}
+        km = PooledKernelManager(config=c)
+
+        try:
+            await km.wait_for_pool()
+            entries = list(km._pools[NATIVE_KERNEL_NAME])
+            for entry in entries:
+                self.assertTrue(entry.client.kc.channels_running)
+                self.assertIn(entry.client, km._clients)
+            client = entries[0].client
+            kc = client.kc
+
+            # The kept client is used for adapting, and closed after handout
+            with mock.patch.object(ExecClient, "start_new_kernel_client") as start:
+                kid = await km.start_kernel(env={"VARFOO": "BARBAR"})
+                start.assert_not_called()
+            self.assertEqual(kid, entries[0].kernel_id)
+            self.assertIsNone(entries[0].client)
+            self.assertFalse(kc.channels_running)
+            self.assertNotIn(client, km._clients)
+
+            await km.shutdown_kernel(entries[1].kernel_id)
+            self.assertIsNone(entries[1].client)
+        finally:
+            await km.shutdown_all()
+
+
+def _write_notebook(path, value):
+    cells = [
+        new_code_cell("prewarmed = %r" % (value,), metadata={"tags": ["hotpot-prewarm"]}),
+        new_code_cell("not_prewarmed = True"),
+    ]
+    nbformat.write(new_notebook(cells=cells), path)
+
+
+class TestPooledKernelManagerNotebook(AsyncTestCase):
+    async def _read_prewarmed(self, km, kid):
+        client = ExecClient(km.get_kernel(kid), _store_outputs=True)
+        async with client.setup_kernel():
+            await client.execute("print(prewarmed, 'not_prewarmed' in globals())")
+        return client._outputs[0]["text"]
+
+    @gen_test(timeout=90)
+    async def test_prewarmed_cells(self):
+        c = Config()
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.max_notebook_pools = 1
+        km = PooledKernelManager(config=c)
+
+        with TemporaryDirectory() as tmp_dir:
+            nb_path = os.path.join(tmp_dir, "notebook.ipynb")
+            _write_notebook(nb_path, 1)
+            try:
+                # The first kernel for a notebook starts its pool
+                await km.start_kernel(notebook_path=nb_path)
+                await km.wait_for_pool()
+                pooled = [e.kernel_id for e in km._notebook_pools[nb_path].pool]
+                self.assertEqual(len(pooled), 1)
+
+                kid = await km.start_kernel(notebook_path=nb_path)
+                self.assertIn(kid, pooled)
+                self.assertEqual(await self._read_prewarmed(km, kid), "1 False\n")
+
+                # Changing the notebook invalidates its pool
+                await km.wait_for_pool()
+                pooled = [e.kernel_id for e in km._notebook_pools[nb_path].pool]
+                _write_notebook(nb_path, 2)
+                os.utime(nb_path, ns=(0, 0))
+                await km.start_kernel(notebook_path=nb_path)
+                await km.wait_for_pool()
+                for kernel_id in pooled:
+                    self.assertNotIn(kernel_id, km._pooled_kernels)
+                kid = await km.start_kernel(notebook_path=nb_path)
+                self.assertEqual(await self._read_prewarmed(km, kid), "2 False\n")
+
+                # Notebooks without prewarm cells don't take the place of those with
+                plain_path = os.path.join(tmp_dir, "plain.ipynb")
+                nbformat.write(new_notebook(cells=[new_code_cell("1")]), plain_path)
+                await km.start_kernel(notebook_path=plain_path)
+                self.assertEqual(list(km._notebook_pools), [nb_path])
+                self.assertIn(plain_path, km._unpooled_notebooks)
+
+                # Only the most recently used notebooks keep their pools
+                other_path = os.path.join(tmp_dir, "other.ipynb")
+                _write_notebook(other_path, 3)
+                await km.start_kernel(notebook_path=other_path)
+                self.assertEqual(list(km._notebook_pools), [other_path])
+            finally:
+                await km.shutdown_all()
+
+    @gen_test(timeout=90)
+    async def test_relative_paths(self):
+        c = Config()
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.max_notebook_pools = 1
+        km = PooledKernelManager(config=c)
+
+        with TemporaryDirectory() as tmp_dir:
+            nb_path = os.path.join(tmp_dir, "notebook.ipynb")
+            with open(os.path.join(tmp_dir, "data.txt"), "w") as f:
+                f.write("data")
+            cells = [
+                new_code_cell(
+                    "prewarmed = open('data.txt').read()", metadata={"tags": ["hotpot-prewarm"]}
+                )
+            ]
+            nbformat.write(new_notebook(cells=cells), nb_path)
+            try:
+                await km.start_kernel(notebook_path=nb_path)
+                await km.wait_for_pool()
+                pooled = [e.kernel_id for e in km._notebook_pools[nb_path].pool]
+                kid = await km.start_kernel(notebook_path=nb_path)
+                self.assertIn(kid, pooled)
+                self.assertEqual(await self._read_prewarmed(km, kid), "data False\n")
+            finally:
+                await km.shutdown_all()
+
+    @gen_test(timeout=90)
+    async def test_failing_prewarm_cell(self):
+        c = Config()
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.max_notebook_pools = 1
+        km = PooledKernelManager(config=c)
+
+        with TemporaryDirectory() as tmp_dir:
+            nb_path = os.path.join(tmp_dir, "notebook.ipynb")
+            cells = [new_code_cell("1 / 0", metadata={"tags": ["hotpot-prewarm"]})]
+            nbformat.write(new_notebook(cells=cells), nb_path)
+            try:
+                kids = [await km.start_kernel(notebook_path=nb_path) for _ in range(3)]
+                await km.wait_for_pool()
+                await asyncio.gather(*km._discarded, return_exceptions=True)
+                # The requests fall back, and the failed kernel is not left running
+                self.assertEqual(sorted(km.list_kernel_ids()), sorted(kids))
+                self.assertNotIn(nb_path, km._notebook_pools)
+                self.assertIn(nb_path, km._unpooled_notebooks)
+            finally:
+                await km.shutdown_all()
+
+
+class TestPooledKernelManagerVariants(AsyncTestCase):
+    async def _getcwd(self, km, kid):
+        client = ExecClient(km.get_kernel(kid), _store_outputs=True)
+        async with client.setup_kernel():
+            await client.execute("import os; print(os.getcwd())")
+        return client._outputs[0]["text"].strip()
+
+    @gen_test(timeout=90)
+    async def test_variant_selection(self):
+        with TemporaryDirectory() as dir_a, TemporaryDirectory() as dir_b:
+            dir_a, dir_b = os.path.realpath(dir_a), os.path.realpath(dir_b)
+            c = Config()
+            c.PooledKernelManager.fill_delay = 0
+            c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 1}
+            c.PooledKernelManager.pool_variants = {
+                NATIVE_KERNEL_NAME: [
+                    dict(kwargs=dict(cwd=dir_a), size=1),
+                    dict(kwargs=dict(cwd=dir_b), size=1),
+                ]
+            }
+            km = PooledKernelManager(config=c)
+
+            try:
+                await km.wait_for_pool()
+                pooled_a, pooled_b = (
+                    [e.kernel_id for e in km._variants[NATIVE_KERNEL_NAME, fingerprint].pool]
+                    for fingerprint in (
+                        kwargs_fingerprint(dict(cwd=dir_a)),
+                        kwargs_fingerprint(dict(cwd=dir_b)),
+                    )
+                )
+
+                # An exact match needs no adaptation
+                kid = await km.start_kernel(cwd=dir_a)
+                self.assertIn(kid, pooled_a)
+                self.assertEqual(km.get_pool_metrics()[NATIVE_KERNEL_NAME].get("adaptations", 0), 0)
+
+                # Otherwise a ready compatible variant is adapted
+                kid = await km.start_kernel(cwd=os.path.dirname(dir_b))
+                self.assertIn(kid, pooled_b)
+                self.assertEqual(km.get_pool_metrics()[NATIVE_KERNEL_NAME]["adaptations"], 1)
+                self.assertEqual(await self._getcwd(km, kid), os.path.dirname(dir_b))
+
+                # Requests matching the pool_kwargs use the kernel_pools pool
+                pooled = [e.kernel_id for e in km._pools[NATIVE_KERNEL_NAME]]
+                self.assertIn(await km.start_kernel(), pooled)
+
+                km.strict_pool_kwargs = True
+                with self.assertRaises(ValueError):
+                    await km.start_kernel(cwd=os.path.dirname(dir_b))
+                await km.start_kernel(cwd=dir_b)
+            finally:
+                await km.shutdown_all()
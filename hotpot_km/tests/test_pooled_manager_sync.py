@@ -82,6 +82,21 @@ class TestSyncPooledKernelManagerApplied(TestKernelManager):
             km.kernel_pools = {NATIVE_KERNEL_NAME: 3}
             self.assertEqual(len(km._pools[NATIVE_KERNEL_NAME]), 3)
 
+    def test_pooled_index(self):
+        with self._get_tcp_km() as km:
+            pooled = list(km._pools[NATIVE_KERNEL_NAME])
+            self.assertEqual(set(km._pooled_kernels), set(pooled))
+
+            kid = km.start_kernel(stdout=PIPE, stderr=PIPE)
+            self.assertIn(kid, pooled)
+            self.assertNotIn(kid, km._pooled_kernels)
+
+            # Shutting down a pooled kernel removes it from the pool
+            other = next(k for k in pooled if k != kid)
+            km.shutdown_kernel(other)
+            self.assertNotIn(other, km._pooled_kernels)
+            self.assertNotIn(other, km._pools[NATIVE_KERNEL_NAME])
+
     def test_breach_max(self):
         with self._get_tcp_km() as km:
             kids = []
@@ -0,0 +1,54 @@
+import subprocess
+import sys
+from time import monotonic
+
+from jupyter_client import AsyncKernelManager
+from tornado.testing import AsyncTestCase, gen_test
+
+from ..client_helper import DeadKernelError, ExecClient
+from ..process_exit import exit_notification_supported, wait_for_exit
+
+
+class _ProcessKernelManager:
+    """Just enough of a kernel manager for a plain process"""
+
+    provisioner = None
+
+    def __init__(self, process):
+        self.kernel = process
+
+    def is_alive(self):
+        return self.kernel.poll() is None
+
+
+class TestWaitForExit(AsyncTestCase):
+    @gen_test(timeout=10)
+    async def test_notified_on_exit(self):
+        process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(0.2)"])
+        try:
+            start = monotonic()
+            # With polling, this would take a full poll_interval
+            await wait_for_exit(_ProcessKernelManager(process), poll_interval=5)
+            if exit_notification_supported():
+                self.assertLess(monotonic() - start, 2)
+        finally:
+            process.kill()
+            process.wait()
+
+    @gen_test(timeout=10)
+    async def test_unknown_process(self):
+        km = _ProcessKernelManager(None)
+        km.is_alive = lambda: False
+        await wait_for_exit(km)
+
+    @gen_test(timeout=60)
+    async def test_execute_kernel_death(self):
+        km = AsyncKernelManager()
+        await km.start_kernel()
+        try:
+            client = ExecClient(km)
+            async with client.setup_kernel():
+                with self.assertRaises(DeadKernelError):
+                    await client.execute("import os; os._exit(1)")
+        finally:
+            await km.shutdown_kernel(now=True)
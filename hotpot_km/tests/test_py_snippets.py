@@ -0,0 +1,72 @@
+import os
+
+from ..py_snippets import (
+    CppSnippets,
+    JuliaSnippets,
+    LanguageSnippets,
+    PythonSnippets,
+    RSnippets,
+    get_language_snippets,
+    language_snippets,
+    register_language_snippets,
+)
+
+
+def test_lookup_by_language():
+    assert isinstance(get_language_snippets("python"), PythonSnippets)
+    assert isinstance(get_language_snippets("R"), RSnippets)
+    assert isinstance(get_language_snippets("julia"), JuliaSnippets)
+    assert isinstance(get_language_snippets("C++17"), CppSnippets)
+    assert isinstance(get_language_snippets("cpp"), CppSnippets)
+    assert get_language_snippets("cobol") is None
+    assert get_language_snippets(None) is None
+
+
+def test_register():
+    snippets = LanguageSnippets()
+    register_language_snippets("Scheme", snippets)
+    try:
+        assert get_language_snippets("scheme") is snippets
+        assert snippets.update_code("/tmp", {}) is None
+    finally:
+        del language_snippets["scheme"]
+
+
+def test_python_update(tmp_path, monkeypatch):
+    monkeypatch.chdir(os.getcwd())
+    monkeypatch.setenv("HOTPOT_UNSET", "1")
+    monkeypatch.delenv("HOTPOT_SET", raising=False)
+    code = PythonSnippets().update_code(
+        str(tmp_path), {"HOTPOT_SET": "a 'quoted' value", "HOTPOT_UNSET": None}
+    )
+    exec(code, {})
+    assert os.getcwd() == str(tmp_path)
+    assert os.environ["HOTPOT_SET"] == "a 'quoted' value"
+    assert "HOTPOT_UNSET" not in os.environ
+
+
+def test_r_update():
+    code = RSnippets().update_code('/a "b"', {"A": "x\ny", "B": None})
+    assert code == '\n'.join(
+        [
+            'setwd("/a \\"b\\"")',
+            'Sys.setenv("A" = "x\\ny")',
+            'Sys.unsetenv(c("B"))',
+            "invisible()",
+        ]
+    )
+
+
+def test_julia_update():
+    code = JuliaSnippets().update_code(None, {"A": "$HOME", "B": None})
+    assert code == '\n'.join(['ENV["A"] = "\\$HOME"', 'delete!(ENV, "B")', "nothing"])
+    assert JuliaSnippets().import_code(["DataFrames"]) == "import DataFrames\nnothing"
+
+
+def test_cpp_update():
+    code = CppSnippets().update_code("/tmp", {"A": 'x"y'})
+    assert 'chdir(R"hotpot(/tmp)hotpot");' in code
+    assert 'setenv(R"hotpot(A)hotpot", R"hotpot(x"y)hotpot", 1);' in code
+    # The raw string delimiter cannot be quoted
+    assert CppSnippets().update_code(')hotpot"', {}) is None
+    assert CppSnippets().update_code(None, {"A": 'x)hotpot"'}) is None
@@ -0,0 +1,46 @@
+import json
+import os
+from unittest import mock
+
+from jupyter_client.kernelspec import KernelSpecManager
+
+from ..spec_cache import KernelSpecCache
+
+
+def _write_spec(kernel_dir, name, language):
+    os.makedirs(kernel_dir / name, exist_ok=True)
+    with open(kernel_dir / name / "kernel.json", "w") as f:
+        json.dump(dict(argv=["echo"], display_name=name, language=language), f)
+
+
+def test_cached_until_changed(tmp_path):
+    _write_spec(tmp_path, "lang_a", "a")
+    ksm = KernelSpecManager(kernel_dirs=[str(tmp_path)], ensure_native_kernel=False)
+    cache = KernelSpecCache(ksm)
+
+    with mock.patch.object(ksm, "get_all_specs", wraps=ksm.get_all_specs) as get_all:
+        assert cache.get_language("lang_a") == "a"
+        assert cache.get_language("lang_a") == "a"
+        assert cache.get_language("missing") is None
+        assert get_all.call_count == 1
+
+        # Adding a kernel changes the directory
+        _write_spec(tmp_path, "lang_b", "b")
+        os.utime(tmp_path, ns=(0, 0))
+        assert cache.get_language("lang_b") == "b"
+        assert get_all.call_count == 2
+
+        # Replacing a kernel.json changes its kernel directory
+        os.remove(tmp_path / "lang_a" / "kernel.json")
+        _write_spec(tmp_path, "lang_a", "c")
+        os.utime(tmp_path / "lang_a", ns=(0, 0))
+        assert cache.get_language("lang_a") == "c"
+        assert get_all.call_count == 3
+
+        # Editing a kernel.json in place does not change its kernel directory
+        dir_stat = os.stat(tmp_path / "lang_a")
+        _write_spec(tmp_path, "lang_a", "d")
+        os.utime(tmp_path / "lang_a", ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+        os.utime(tmp_path / "lang_a" / "kernel.json", ns=(1, 1))
+        assert cache.get_language("lang_a") == "d"
+        assert get_all.call_count == 4
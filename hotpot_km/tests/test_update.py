@@ -104,3 +104,40 @@ class TestUpdatePooled(AsyncTestCase):
                 )
             finally:
                 await km.shutdown_all()
+
+    @gen_test
+    async def test_cwd_env_unset(self):
+        with TemporaryDirectory() as tmp_dir:
+            c = Config()
+            c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 1}
+            c.PooledKernelManager.pool_kwargs = {
+                NATIVE_KERNEL_NAME: dict(env={"VARFOO": "BARBAR", "VARBAZ": "1"})
+            }
+            km = PooledKernelManager(config=c)
+
+            try:
+                await km.wait_for_pool()
+                kid = await km.start_kernel(
+                    cwd=tmp_dir, env={"VARFOO": "QUUX", "VARBAZ": None}
+                )
+                client = ExecClient(km.get_kernel(kid), _store_outputs=True)
+                async with client.setup_kernel():
+                    await client.execute(
+                        "import os\n"
+                        'print(os.getcwd(), os.environ["VARFOO"], os.environ.get("VARBAZ"))'
+                    )
+                self.assertEqual(
+                    client._outputs,
+                    [
+                        {
+                            "name": "stdout",
+                            "output_type": "stream",
+                            "text": f"{Path(tmp_dir).resolve()} QUUX None\n",
+                        }
+                    ],
+                )
+                metrics = km.get_pool_metrics()[NATIVE_KERNEL_NAME]
+                self.assertEqual(metrics["adaptations"], 1)
+                self.assertGreater(metrics["adaptation_time_total"], 0)
+            finally:
+                await km.shutdown_all()
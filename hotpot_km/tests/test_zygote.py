@@ -0,0 +1,70 @@
+import os
+
+from jupyter_client.kernelspec import NATIVE_KERNEL_NAME
+import pytest
+from tornado.testing import AsyncTestCase, gen_test
+from traitlets.config.loader import Config
+
+from ..client_helper import ExecClient
+from ..memory import kernel_pid
+from ..zygote import ForkedProcess, ipykernel_args, zygote_supported
+
+try:
+    from .. import PooledKernelManager
+except ImportError:
+    pass
+
+
+def test_ipykernel_args():
+    cmd = ["python", "-m", "ipykernel_launcher", "-f", "conn.json"]
+    assert ipykernel_args(cmd) == ["-f", "conn.json"]
+    assert ipykernel_args(["R", "--slave", "-e", "IRkernel::main()"]) is None
+
+
+def test_forked_process_gone():
+    pid = os.getpid()
+    process = ForkedProcess(pid)
+    assert process.poll() is None
+    process.pid = 2 ** 22 + 1  # beyond pid_max
+    assert process.poll() == 0
+
+
+@pytest.mark.skipif(not zygote_supported(), reason="Requires fork and kernel provisioners")
+class TestPooledKernelManagerZygote(AsyncTestCase):
+    @gen_test(timeout=60)
+    async def test_forked_kernels(self):
+        c = Config()
+        c.PooledKernelManager.fill_delay = 0
+        c.PooledKernelManager.kernel_pools = {NATIVE_KERNEL_NAME: 2}
+        c.PooledKernelManager.python_imports = ["turtle"]
+        c.PooledKernelManager.pool_zygote = [NATIVE_KERNEL_NAME]
+        km = PooledKernelManager(config=c)
+
+        try:
+            kid = await km.start_kernel()
+            kernel = km.get_kernel(kid)
+            self.assertIsInstance(kernel.provisioner.process, ForkedProcess)
+            zygote = km._zygotes[NATIVE_KERNEL_NAME]
+            with open(f"/proc/{kernel_pid(kernel)}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            self.assertEqual(ppid, zygote.pid)
+
+            client = ExecClient(kernel, _store_outputs=True)
+            async with client.setup_kernel():
+                await client.execute('import sys\nprint("turtle" in sys.modules)')
+            self.assertEqual(
+                client._outputs,
+                [{"name": "stdout", "output_type": "stream", "text": "True\n"}],
+            )
+
+            # Restarts fork a new kernel
+            pid = kernel_pid(kernel)
+            await km.restart_kernel(kid)
+            self.assertNotEqual(kernel_pid(kernel), pid)
+            self.assertTrue(await kernel.is_alive())
+
+            await km.shutdown_kernel(kid)
+            self.assertIsNotNone(ForkedProcess(pid).poll())
+        finally:
+            await km.shutdown_all()
+        self.assertIsNone(zygote.pid)
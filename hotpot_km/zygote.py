@@ -0,0 +1,191 @@
+# coding: utf-8
+
+# Copyright (c) Vidar Tonaas Fauske.
+# Distributed under the terms of the Modified BSD License.
+"""Hotpot - Jupyter kernel manager helpers
+
+This module contains helpers for forking Python kernels from a template
+("zygote") process, that has already imported ipykernel and any configured
+modules. Forked kernels start in milliseconds, and share the memory pages of
+the imported modules copy-on-write.
+"""
+
+import asyncio
+import json
+import os
+import signal
+import time
+from pathlib import Path
+
+
+_MAIN = str(Path(__file__).with_name("_zygote_main.py"))
+
+_LAUNCHER_MODULES = ("ipykernel_launcher", "ipykernel")
+
+
+def zygote_supported():
+    """Whether kernels can be forked from a zygote on this platform"""
+    if not hasattr(os, "fork"):
+        return False
+    try:
+        import jupyter_client.provisioning  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def ipykernel_args(cmd):
+    """Get the ipykernel arguments of a kernel command, or None if it is not an ipykernel"""
+    if len(cmd) >= 3 and cmd[1] == "-m" and cmd[2] in _LAUNCHER_MODULES:
+        return list(cmd[3:])
+    return None
+
+
+class ForkedProcess:
+    """A Popen-like handle of a kernel forked by a zygote.
+
+    The zygote reaps its children, so the exit status is not available, and
+    is reported as 0.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                self.returncode = 0
+            except PermissionError:
+                # The pid has been reused by another user
+                self.returncode = 0
+        return self.returncode
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.poll() is None:
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError("Process %s did not exit" % (self.pid,))
+            time.sleep(0.01)
+        return self.returncode
+
+    def send_signal(self, signum):
+        if self.poll() is None:
+            os.kill(self.pid, signum)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class Zygote:
+    """A template process that forks kernels.
+
+    The process is started with the Python of the first kernel command it is
+    asked to fork, and restarted if it exits.
+    """
+
+    def __init__(self, modules, log):
+        self.modules = list(modules)
+        self.log = log
+        self._process = None
+        self._python = None
+        self._lock = None
+
+    @property
+    def pid(self):
+        return self._process.pid if self._process is not None else None
+
+    async def _start(self, python):
+        self.log.info("Starting kernel zygote with %s", python)
+        self._process = await asyncio.create_subprocess_exec(
+            python,
+            _MAIN,
+            *self.modules,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        self._python = python
+        line = await self._process.stdout.readline()
+        if line.strip() != b"ready":
+            await self.stop()
+            raise RuntimeError("Kernel zygote failed to start")
+
+    async def fork(self, cmd, env, cwd=None):
+        """Fork a kernel from a kernel command, returning its pid"""
+        args = ipykernel_args(cmd)
+        if args is None:
+            raise ValueError("Cannot fork kernel command %r" % (cmd,))
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._process is None or self._process.returncode is not None:
+                await self._start(cmd[0])
+            elif cmd[0] != self._python:
+                raise ValueError("Kernel zygote runs %s, not %s" % (self._python, cmd[0]))
+            request = dict(argv=args, env=dict(env), cwd=cwd and str(cwd))
+            self._process.stdin.write(json.dumps(request).encode() + b"\n")
+            await self._process.stdin.drain()
+            line = await self._process.stdout.readline()
+        if not line:
+            raise RuntimeError("Kernel zygote exited")
+        return json.loads(line)["pid"]
+
+    async def stop(self):
+        """Stop the zygote. Kernels forked from it exit with it."""
+        process = self._process
+        self._process = None
+        if process is None or process.returncode is not None:
+            return
+        process.stdin.close()
+        try:
+            await asyncio.wait_for(process.wait(), 5)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+
+__all__ = [
+    "ForkedProcess",
+    "Zygote",
+    "ipykernel_args",
+    "zygote_supported",
+]
+
+
+try:
+    from jupyter_client.provisioning import LocalProvisioner
+
+    class ZygoteProvisioner(LocalProvisioner):
+        """A provisioner that forks kernels from a zygote, if possible.
+
+        Falls back to launching a new process if the kernel is not an
+        ipykernel, or if the zygote fails.
+        """
+
+        zygote = None
+
+        async def launch_kernel(self, cmd, **kwargs):
+            if self.zygote is None or ipykernel_args(cmd) is None:
+                return await super().launch_kernel(cmd, **kwargs)
+            try:
+                pid = await self.zygote.fork(
+                    cmd, kwargs.get("env") or os.environ, kwargs.get("cwd")
+                )
+            except Exception:
+                self.log.warning("Failed to fork kernel, launching it instead", exc_info=True)
+                return await super().launch_kernel(cmd, **kwargs)
+            self.process = ForkedProcess(pid)
+            self.pid = pid
+            # The forked kernel leads its own session
+            self.pgid = pid
+            return self.connection_info
+
+    __all__.append("ZygoteProvisioner")
+
+except ImportError:
+    pass